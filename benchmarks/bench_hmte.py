@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.bench_hmte
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Template expansion time and peak memory on synthetic templates
+    of growing loop nesting depth and list length
+
+    run from the repository root:
+        python -m benchmarks.bench_hmte [maxdepth [maxlength]]
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from code import hmte
+
+
+def synthetic_template(depth, length):
+    """
+    Select list with depth nested loops over lists of length items
+    """
+    names = ["v{}".format(level) for level in range(depth)]
+    head, tail = [], []
+    for level, name in enumerate(names):
+        indent = "    " * (level + 1)
+        items = ", ".join("{}x{}".format(name, i) for i in range(length))
+        head.append("{}-- for {} in [{}] --\n".format(indent, name, items))
+        tail.insert(0, "{}-- end --\n".format(indent))
+    field = "    " * (depth + 1) + "t.{" + "}_{".join(names) + "}Mag AS {s}{name},\n"
+    return "SELECT\n" + "".join(head) + field + "".join(tail) + "FROM {table} AS t\n"
+
+
+def measure(template, repeat=3, **kw):
+    hmte.compile_template(template)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        query = hmte.expand_templates(template, **kw)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    hmte.expand_templates(template, **kw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, len(query)
+
+
+def main(maxdepth=4, maxlength=32):
+    maxdepth, maxlength = int(maxdepth), int(maxlength)
+    print("{:>5s} {:>6s} {:>12s} {:>10s} {:>10s} {:>10s}".format(
+        "depth", "length", "output, kB", "time, ms", "ns/byte", "peak, kB"))
+    for depth in range(1, maxdepth + 1):
+        length = 2
+        while length <= maxlength and length**depth <= 10**6:
+            template = synthetic_template(depth, length)
+            elapsed, peak, size = measure(template, s="", name="x", table="StackModelFitSer")
+            print("{:5d} {:6d} {:12.1f} {:10.2f} {:10.1f} {:10.1f}".format(
+                depth, length, size / 1024, 1e3 * elapsed, 1e9 * elapsed / size, peak / 1024))
+            length *= 2
+
+
+if __name__ == "__main__":
+    main(*map(float, sys.argv[1:]))
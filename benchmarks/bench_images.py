@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.bench_images
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Color image throughput: one fresh connection per image (as before)
+    against the pooled session and the asyncio API
+
+    run from the repository root:
+        python -m benchmarks.bench_images [nimages [latency]]
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import sys
+import time
+import asyncio
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+from astropy.table import Table
+
+from code import panstarrs
+from benchmarks.mockps1 import MockPS1Process
+
+
+def fresh_connections(positions):
+    for ra, dec in positions:
+        names = Table.read(requests.get(
+            "{}/ps1filenames.py?ra={}&dec={}&filters=grizy".format(panstarrs.SERVICE_URL, ra, dec)
+        ).text, format='ascii')
+        url = "{}/fitscut.cgi?ra={}&dec={}&size=240&format=jpg".format(panstarrs.SERVICE_URL, ra, dec)
+        for param, name in zip(["red", "green", "blue"], names['filename'][[4, 2, 0]]):
+            url += "&{}={}".format(param, name)
+        r = requests.get(url)
+        Image.open(BytesIO(r.content)).load()
+
+
+def pooled(positions):
+    for ra, dec in positions:
+        panstarrs.fetchimage(panstarrs.geturl(ra, dec, color=True, local=False))
+
+
+def pooled_async(positions):
+    asyncio.run(panstarrs.fetch_color_many(positions, local=False))
+
+
+def main(nimages=200, latency=0.02):
+    nimages = int(nimages)
+    rng = np.random.default_rng(0)
+    positions = list(zip(rng.uniform(0, 360, nimages), rng.uniform(-30, 90, nimages)))
+    with MockPS1Process(latency=latency) as server:
+        panstarrs.SERVICE_URL = server.url
+        for bench in (fresh_connections, pooled, pooled_async):
+            start = time.perf_counter()
+            bench(positions)
+            elapsed = time.perf_counter() - start
+            print("{:20s} {:8.1f} images/s".format(bench.__name__, nimages / elapsed))
+
+
+if __name__ == "__main__":
+    main(*map(float, sys.argv[1:]))
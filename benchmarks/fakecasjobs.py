@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.fakecasjobs
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    In-process stand-in for a CasJobs client
+
+    `quick` answers cone searches (fGetNearbyObjEq calls and
+    `crosstools.cone_batch_search` VALUES rowsets) with synthetic objects,
+    other queries get objects around (0, 0). Results are deterministic for
+    a given query text. Comments are ignored; a repeated, malformed or
+    stray VALUES rowset fails the query, as it would on the server.
+
+    Long queue jobs (`submit`, `status`, `monitor`) take `latency` seconds
+    and write their result into the table named after INTO, to be read
+    with `get_table` and removed with `drop_table`, which fails on missing
+    tables like the real client, or `drop_table_if_exists`.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import re
+import time
+import random
+import hashlib
+import threading
+from argparse import Namespace
+
+import numpy as np
+from astropy.table import Table
+
+_number = r"\s*(-?[\d.eE+-]+)\s*"
+_cone = re.compile(r"fGetNearbyObjEq\(" + ",".join([_number]*3) + r"\)")
+_into = re.compile(r"\bINTO\s+(?:MyDB\.)?(\w+)", re.I)
+_row = r"\(\s*(\d+)," + ",".join([_number]*3) + r"\)"
+_rowset = re.compile(_row)
+_values = re.compile(r"\(\s*VALUES\b(.*?)\)\s*AS\s+\w+\s*\(", re.I | re.S)
+_comment = re.compile(r"--[^\n]*")
+
+COLUMNS = ["GalMajor", "GalMinor", "GalPhi", "GalIndex", "GalMag",
+           "SerRadius", "SerAb", "SerPhi", "SerMag", "KronRad", "petRadius"]
+
+
+class FakeJobs:
+    """
+    latency      -- seconds every call takes
+    failure_rate -- fraction of calls raising an exception
+    nobjects     -- objects found around every position
+    """
+    def __init__(self, latency=0., failure_rate=0., nobjects=20, bands="grizy", seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.nobjects = nobjects
+        self.bands = bands
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.mydb = {}
+
+    def _fails(self):
+        with self.lock:
+            self.calls += 1
+            return self.random.random() < self.failure_rate
+
+    def _call(self):
+        fails = self._fails()
+        time.sleep(self.latency)
+        if fails:
+            raise Exception("fake CasJobs failure")
+
+    def _positions(self, query):
+        query = _comment.sub("", query)
+        rowsets = _values.findall(query)
+        if len(rowsets) > 1 or len(rowsets) < len(re.findall(r"\bVALUES\b", query, re.I)):
+            raise Exception("fake CasJobs: malformed or repeated VALUES rowset")
+        if rowsets:
+            rows = _rowset.findall(rowsets[0])
+            if (not re.fullmatch(r"\s*{0}(\s*,\s*{0})*\s*".format(_row), rowsets[0])
+                    or len(rows) != len(_rowset.findall(query))):
+                raise Exception("fake CasJobs: malformed VALUES rowset")
+            return [tuple(map(float, m)) for m in rows], True
+        cones = [(0.,) + tuple(map(float, m)) for m in _cone.findall(query)]
+        if cones:
+            return cones, False
+        return [(0., 0., 0., 1.)], False
+
+    def table(self, query):
+        """
+        Synthetic result of query
+        """
+        seed = int(hashlib.sha1(query.encode()).hexdigest()[:8], 16)
+        rng = np.random.default_rng(seed)
+        positions, with_id = self._positions(query)
+        n = self.nobjects
+        cols = {}
+        if with_id:
+            cols['id'] = np.repeat([int(p[0]) for p in positions], n)
+        cols['objID'] = rng.integers(10**17, 2*10**17, n*len(positions))
+        cols['objName'] = ["PSO J{:017d}".format(i) for i in cols['objID']]
+        ra = np.repeat([p[1] for p in positions], n)
+        dec = np.repeat([p[2] for p in positions], n)
+        r = np.repeat([p[3] for p in positions], n) / 60 * np.sqrt(rng.uniform(size=len(ra)))
+        phi = rng.uniform(0, 2*np.pi, len(ra))
+        cols['raMean'] = ra + r*np.cos(phi) / np.cos(np.radians(dec))
+        cols['decMean'] = dec + r*np.sin(phi)
+        for f in self.bands:
+            for c in COLUMNS:
+                values = rng.uniform(0.5, 20, len(ra))
+                values[rng.uniform(size=len(ra)) < 0.1] = -999.
+                cols[f + c] = values
+        return Table(cols)
+
+    def quick(self, query, task_name=None, **kwargs):
+        self._call()
+        return self.table(query)
+
+    def submit(self, query, context="MyDB", task_name=None, **kwargs):
+        """
+        Start a long queue job, returns its id
+        """
+        into = _into.search(query)
+        if into is None:
+            raise Exception("long queue queries must write INTO a table")
+        fails = self._fails()
+        with self.lock:
+            if into[1] in self.mydb:
+                raise Exception("table {} already exists".format(into[1]))
+            jobid = len(self.jobs) + 1
+            self.jobs[jobid] = Namespace(query=query, table=into[1], failed=fails,
+                                         finish=time.time() + self.latency, done=False)
+        return jobid
+
+    def status(self, jobid):
+        """
+        (code, name) like CasJobs: 1 started, 4 failed, 5 finished
+        """
+        job = self.jobs[jobid]
+        if time.time() < job.finish:
+            return 1, "started"
+        if job.failed:
+            return 4, "failed"
+        with self.lock:
+            if not job.done:
+                self.mydb[job.table] = self.table(job.query)
+                job.done = True
+        return 5, "finished"
+
+    def monitor(self, jobid, timeout=5):
+        """
+        Wait for the job to end, returns its status
+        """
+        while True:
+            code, name = self.status(jobid)
+            if code in (3, 4, 5):
+                return code, name
+            time.sleep(min(timeout, max(0., self.jobs[jobid].finish - time.time())))
+
+    def get_table(self, name, format="FITS"):
+        self._call()
+        with self.lock:
+            if name not in self.mydb:
+                raise Exception("no table {} in MyDB".format(name))
+            return self.mydb[name].copy()
+
+    def drop_table(self, name):
+        with self.lock:
+            if name not in self.mydb:
+                raise Exception("Couldn't drop table {}".format(name))
+            del self.mydb[name]
+
+    def drop_table_if_exists(self, name):
+        with self.lock:
+            self.mydb.pop(name, None)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.mockps1
+    ~~~~~~~~~~~~~~~~~~
+
+    Local stand-in for the PS1 image server
+
+    Serves ps1filenames.py tables and fitscut.cgi images (jpg, png or fits)
+    of synthetic noise after `latency` seconds, failing a `failure_rate`
+    fraction of requests with 503.
+    Point `code.panstarrs.SERVICE_URL` to `server.url`.
+
+    `MockPS1Server` runs in a thread of the calling process, so its CPU
+    work competes with the client for the GIL; `MockPS1Process` runs it in
+    a child process, as a real server would be.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import time
+import random
+import threading
+import multiprocessing
+from io import BytesIO, StringIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from PIL import Image
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from code.skycells import getimages_local
+
+
+def _image_bytes(size, format, ra=0., dec=0.):
+    rng = np.random.default_rng(size)
+    buf = BytesIO()
+    if format == "fits":
+        wcs = WCS(naxis=2)
+        wcs.wcs.crpix = [size/2, size/2]
+        wcs.wcs.cdelt = [-0.25/3600, 0.25/3600]
+        wcs.wcs.crval = [ra, dec]
+        wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+        data = rng.normal(size=(size, size)).astype(np.float32)
+        fits.PrimaryHDU(data, header=wcs.to_header()).writeto(buf)
+    else:
+        pixels = rng.integers(0, 255, size=(size, size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(buf, format="jpeg" if format == "jpg" else format)
+    return buf.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        if self.server.random.random() < self.server.failure_rate:
+            self.server.failures += 1
+            self.send_error(503)
+            return
+        if url.path.endswith("ps1filenames.py"):
+            table = getimages_local(float(query['ra']), float(query['dec']),
+                                    filters=query.get('filters', "grizy"))
+            buf = StringIO()
+            table.write(buf, format='ascii.basic')
+            body = buf.getvalue().encode()
+        elif url.path.endswith("fitscut.cgi"):
+            body = _image_bytes(int(query.get('size', 240)), query.get('format', "jpg"),
+                                float(query['ra']), float(query['dec']))
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockPS1Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0., failure_rate=0., seed=0):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def url(self):
+        return "http://{}:{}/cgi-bin".format(*self.server_address)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def _serve(conn, kwargs):
+    server = MockPS1Server(**kwargs)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+class MockPS1Process:
+    """
+    `MockPS1Server` in a child process, same arguments
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child, self.kwargs),
+                                               daemon=True)
+        self.process.start()
+        self.url = parent.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.run
+    ~~~~~~~~~~~~~~
+
+    End-to-end benchmarks of the data access paths against local fakes
+
+    Every workload reports requests per second, p50/p99 latency of single
+    calls, cache hit ratio where a cache is involved and peak traced memory.
+    Caches live in a temporary directory.
+
+    run from the repository root:
+        python -m benchmarks.run [-n NREQUESTS] [--latency SEC] [--failures RATE] [--json FILE]
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from code import panstarrs, crosstools
+from code.arraystore import ArrayStore
+from code.querycache import QueryCache
+from benchmarks.mockps1 import MockPS1Process
+from benchmarks.fakecasjobs import FakeJobs
+
+CONE_TEMPLATE = """
+SELECT o.objID, o.objName, o.raMean, o.decMean
+FROM fGetNearbyObjEq({ra}, {dec}, {s}) AS nb
+INNER JOIN MeanObjectView AS o ON o.objID = nb.objID
+"""
+
+
+def measure(name, calls, batch=None, stats=None):
+    """
+    Run calls one by one (or batch() once if given) and collect numbers,
+    failed single calls are counted, not retried
+
+    stats -- callable returning (hits, misses) of the cache involved
+    """
+    before = stats() if stats else (0, 0)
+    tracemalloc.start()
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    if batch is None:
+        for call in calls:
+            t = time.perf_counter()
+            try:
+                call()
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t)
+    else:
+        batch()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = dict(workload=name, requests=len(calls), errors=errors, seconds=elapsed,
+                  rps=len(calls) / elapsed, peak_mb=peak / 2**20)
+    if latencies:
+        result['p50_ms'] = 1e3 * np.percentile(latencies, 50)
+        result['p99_ms'] = 1e3 * np.percentile(latencies, 99)
+    if stats:
+        hits, misses = (a - b for a, b in zip(stats(), before))
+        result['hit_ratio'] = hits / max(1, hits + misses)
+    return result
+
+
+def cutout_stats():
+    return crosstools.cutouts.stats.hits, crosstools.cutouts.stats.misses
+
+
+def query_stats():
+    s = crosstools.queries.stats
+    return s.memory_hits + s.disk_hits, s.misses
+
+
+def run(n=100, latency=0.05, failures=0., size=120):
+    rng = np.random.default_rng(0)
+    positions = list(zip(rng.uniform(0, 360, n), rng.uniform(-30, 90, n)))
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockPS1Process(latency=latency, failure_rate=failures) as server:
+        panstarrs.SERVICE_URL = server.url
+        crosstools.cutouts = ArrayStore(Path(tmp) / "cutouts")
+        crosstools.queries = QueryCache(Path(tmp) / "queries")
+
+        results.append(measure("getimages (service)", [
+            lambda p=p: panstarrs.getimages(*p, filters="g") for p in positions]))
+        results.append(measure("geturl (local)", [
+            lambda p=p: panstarrs.geturl(*p, format="fits", filters="g") for p in positions]))
+        results.append(measure("geturl (service)", [
+            lambda p=p: panstarrs.geturl(*p, format="fits", filters="g", local=False)
+            for p in positions]))
+
+        single = [lambda p=p: crosstools._fetch_cutout(p, size, "g", retries=3, backoff=0.01)
+                  for p in positions]
+        results.append(measure("getfits cold", single, stats=cutout_stats))
+        results.append(measure("getfits warm", single, stats=cutout_stats))
+        crosstools.cutouts.clear()
+        results.append(measure(
+            "fetch_fits_many cold", single, stats=cutout_stats,
+            batch=lambda: crosstools.fetch_fits_many(
+                [(p, size, "g") for p in positions], backoff=0.01)))
+
+        jobs = FakeJobs(latency=latency, failure_rate=0.)
+        cones = [lambda p=p: crosstools.cone_galaxy_search(jobs, CONE_TEMPLATE, p, 0.5, "g")
+                 for p in positions]
+        results.append(measure("cone_search_getobjs cold", cones, stats=query_stats))
+        results.append(measure("cone_search_getobjs warm", cones, stats=query_stats))
+        crosstools.queries.invalidate()
+        table = pd.DataFrame({'id': np.arange(n), 'ra': [p[0] for p in positions],
+                              'dec': [p[1] for p in positions], 'size': 0.5})
+        template = (Path(__file__).parent.parent / "queries" / "batch_cone.tsql").read_text()
+        results.append(measure(
+            "cone_batch_search cold", cones, stats=query_stats,
+            batch=lambda: crosstools.cone_batch_search(jobs, template, table, "g")))
+
+    return results
+
+
+def report(results, out=sys.stdout):
+    columns = ['rps', 'p50_ms', 'p99_ms', 'hit_ratio', 'peak_mb', 'errors']
+    print("{:28s}".format("workload") + "".join("{:>11s}".format(c) for c in columns), file=out)
+    for r in results:
+        print("{:28s}".format(r['workload']) + "".join(
+            "{:11.2f}".format(r[c]) if c in r else "{:>11s}".format("-") for c in columns
+        ), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=100, help="requests per workload")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake server latency, s")
+    parser.add_argument("--failures", type=float, default=0., help="fraction of failing requests")
+    parser.add_argument("--json", help="also dump results to this file")
+    args = parser.parse_args()
+
+    results = run(args.n, args.latency, args.failures)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
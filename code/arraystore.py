@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    code.arraystore
+    ~~~~~~~~~~~~~~~
+
+    Size-bounded on-disk store of numpy arrays
+
+    Every entry is a raw .npy file, so it can be memory-mapped on read,
+    plus a small json file with metadata next to it.
+    Least recently used entries are evicted to stay under the byte budget.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from argparse import Namespace
+
+import numpy as np
+
+
+class ArrayStore:
+    """
+    Directory of memory-mappable arrays with LRU eviction
+
+    path     -- directory to keep entries in
+    maxbytes -- disk budget for all the entries together
+    """
+    def __init__(self, path, maxbytes=2**31):
+        self.path = Path(path)
+        self.maxbytes = maxbytes
+        self.stats = Namespace(hits=0, misses=0, evictions=0)
+        # key -> size of entries in LRU order and their total,
+        # read from the directory on first need
+        self._index = None
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        """
+        Stable key from any reprable parts
+        """
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _files(self, key):
+        return self.path / (key + ".npy"), self.path / (key + ".json")
+
+    def get(self, key):
+        """
+        Returns (read-only memory map, metadata dict) or None
+        """
+        datafile, metafile = self._files(key)
+        try:
+            data = np.load(datafile, mmap_mode='r')
+            with open(metafile) as f:
+                meta = json.load(f)
+            os.utime(datafile)  # mark as recently used
+        except (OSError, ValueError):
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        with self._lock:
+            if self._index is not None and key in self._index:
+                self._index.move_to_end(key)
+        return data, meta
+
+    def put(self, key, data, meta={}):
+        """
+        Store array with metadata, returns the stored entry as get() does
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        datafile, metafile = self._files(key)
+        # write to temporary files and rename, so that concurrent
+        # readers never see half-written entries; metadata goes first
+        # as a data file is what marks the entry as present
+        suffix = ".{}.{}.tmp".format(os.getpid(), threading.get_ident())
+        with open(str(metafile) + suffix, 'w') as f:
+            json.dump(meta, f)
+        os.replace(str(metafile) + suffix, metafile)
+        with open(str(datafile) + suffix, 'wb') as f:
+            np.save(f, data)
+        os.replace(str(datafile) + suffix, datafile)
+
+        size = datafile.stat().st_size + metafile.stat().st_size
+        with self._lock:
+            if self._index is None:
+                self._scan()
+            self._total += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self._trim(keep=key)
+        try:
+            return np.load(datafile, mmap_mode='r'), meta
+        except OSError:  # evicted by another process meanwhile
+            return data, meta
+
+    def _scan(self):
+        """
+        Read sizes and LRU order of entries from the directory
+        """
+        entries = []
+        for datafile in self.path.glob("*.npy"):
+            metafile = datafile.with_suffix(".json")
+            try:
+                st = datafile.stat()
+                size = st.st_size + (metafile.stat().st_size if metafile.exists() else 0)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, datafile.stem, size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._total = sum(self._index.values())
+
+    def _trim(self, keep=None):
+        """
+        Drop least recently used entries other than keep
+        until the store fits into maxbytes
+        """
+        while self._total > self.maxbytes:
+            key = next((k for k in self._index if k != keep), None)
+            if key is None:
+                break
+            for f in self._files(key):
+                try:
+                    f.unlink()
+                except OSError:
+                    pass
+            self._total -= self._index.pop(key)
+            self.stats.evictions += 1
+
+    def evict(self):
+        """
+        Drop least recently used entries until the store fits into maxbytes,
+        rereading the directory to see entries of other processes
+        """
+        with self._lock:
+            self._scan()
+            self._trim()
+
+    def clear(self):
+        for f in list(self.path.glob("*.npy")) + list(self.path.glob("*.json")):
+            f.unlink()
+        with self._lock:
+            self._index, self._total = OrderedDict(), 0
@@ -10,11 +10,13 @@
 """
 
 import numpy as np
-from joblib import Memory
+import pandas as pd
 
 from astropy.visualization import PercentileInterval, AsinhStretch, LogStretch, LinearStretch
 from scipy.ndimage import rotate as rotim
+from scipy.ndimage import affine_transform
 from matplotlib.patches import Ellipse, Circle
+from matplotlib.collections import EllipseCollection
 import matplotlib.transforms as transforms
 import matplotlib.pyplot as plt
 
@@ -23,9 +25,19 @@ from astropy.wcs import WCS
 
 import astropy.utils
 
+import re
 import warnings
-
-from .panstarrs import geturl
+import time
+import requests
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .panstarrs import geturl, session
+from .arraystore import ArrayStore
+from . import display
+from .display import display_image
+from .querycache import QueryCache
+from .tablestore import replace_sentinels, compact
 
 from argparse import Namespace
 PANPARS = Namespace()
@@ -35,30 +47,106 @@ PANPARS.defaultvalue = -999.0
 astropy.utils.data.Conf.remote_timeout = 100
 
 cachedir = "./cached/"
-memory = Memory(cachedir, verbose=0)
+cutouts = ArrayStore(cachedir + "cutouts", maxbytes=2**31)
+queries = QueryCache(cachedir + "queries")
 
 
 def clean_cache():
-    memory.clear()
+    queries.invalidate()
+    cutouts.clear()
+    display.previews.clear()
 
 
-@memory.cache
-def cone_search_getobjs(jobs, query, **kwargs):
+def _quick_getobjs(jobs, query):
     results = jobs.quick(query, task_name="galaxy-like cone search")
-    df = results.to_pandas()
-    df[df == PANPARS.defaultvalue] = np.nan
-    return df
+    df = replace_sentinels(results.to_pandas(), PANPARS.defaultvalue)
+    return compact(df)
+
+
+def cone_search_getobjs(jobs, query, **kwargs):
+    """
+    Results of query, cached in `queries` by the query text only,
+    the frame is shared with the cache and must not be modified
+    """
+    return queries.fetch(query, lambda q: _quick_getobjs(jobs, q))
 
 
-def cone_galaxy_search(jobs, template, pos, size, filt):
+def cone_galaxy_search(jobs, template, pos, size, filt, store=None):
     """
     pos -- in degrees, size -- in arcmin
+    store -- `skycache.ConeStore` to answer from local data where possible
     """
+    if store is not None:
+        return store.search(lambda query: cone_search_getobjs(jobs, query),
+                            template, pos, size, filt)
+
     query = template.format(ra=pos[0], dec=pos[1], s=size, f=filt)
 
     return cone_search_getobjs(jobs, query)
 
 
+def _positions_rowset(positions):
+    """
+    Render (id, ra, dec, size) rows as a derived table named `pos`
+    """
+    rows = ",\n        ".join(
+        "({:d}, {!r}, {!r}, {!r})".format(int(i), float(ra), float(dec), float(s))
+        for i, ra, dec, s in positions[['id', 'ra', 'dec', 'size']].itertuples(index=False)
+    )
+    return "(VALUES\n        {}\n    ) AS pos(id, ra, dec, s)".format(rows)
+
+
+# messages of CasJobs errors a smaller query may get past
+_limit_errors = re.compile(
+    r"time ?out|timed out|time limit|exceed|too (large|long|many)|out of memory|row limit",
+    re.I)
+
+
+def _cone_batch_chunk(jobs, template, positions, filt):
+    """
+    Run one set-based query, halving the chunk if the server
+    refuses it for its size or time limits
+    """
+    query = template.format(positions=_positions_rowset(positions), f=filt)
+    try:
+        return [cone_search_getobjs(jobs, query)]
+    except Exception as e:
+        if len(positions) == 1 or not _limit_errors.search(str(e)):
+            raise
+        half = len(positions) // 2
+        return (_cone_batch_chunk(jobs, template, positions.iloc[:half], filt) +
+                _cone_batch_chunk(jobs, template, positions.iloc[half:], filt))
+
+
+def cone_batch_search(jobs, template, positions, filt, chunksize=200):
+    """
+    Cone search around many positions with a few set-based queries
+
+    positions -- table with `id`, `ra`, `dec` (in degrees) and `size`
+                 (radius in arcmin) columns
+    template  -- query selecting from `{positions}` rowset (see
+                 queries/batch_cone.tsql), it must return the `id` column
+
+    Positions are sent in chunks of `chunksize`; a chunk the server
+    fails on for row or time limits is split in halves and retried,
+    other errors are raised at once.
+
+    Returns dict id -> DataFrame of objects found around that position
+    """
+    positions = pd.DataFrame(positions)
+    results = []
+    for start in range(0, len(positions), chunksize):
+        chunk = positions.iloc[start:start+chunksize]
+        results += _cone_batch_chunk(jobs, template, chunk, filt)
+
+    if not results:
+        return {}
+    df = pd.concat(results, ignore_index=True)
+    found = {i: group.drop(columns='id') for i, group in df.groupby('id')}
+    empty = df.iloc[:0].drop(columns='id')
+    return {i: found.get(i, empty) for i in positions['id']}
+
+
 def inellipse(pos, center, theta, a, b):
     """
     A test whether a point lies inside rotated ellipse
@@ -100,12 +188,221 @@ def place_ellipse(a, b, pos, theta, color, label, ls='-', ax=None,
     ax.add_patch(el)
 
 
-@memory.cache(ignore=['pos'])
+def place_ellipses(a, b, pos, theta, color, label, ls='-', ax=None):
+    """
+    Draw many ellipses on matplotlib axes object as a single collection
+
+    a, b, theta and rows of pos are arrays of the same length
+    """
+    ax = plt.gca() if ax is None else ax
+    a, b, theta = np.asarray(a, float), np.asarray(b, float), np.asarray(theta, float)
+    ok = np.isfinite(a) & np.isfinite(b) & np.isfinite(theta)
+
+    ax.add_collection(EllipseCollection(
+        2*a[ok], 2*b[ok], theta[ok], units='xy',
+        offsets=np.asarray(pos)[ok], offset_transform=ax.transData,
+        facecolors='none', edgecolors=color, linestyles=ls
+    ))
+    # collections have no legend handler, an empty line stands for them
+    ax.plot([], [], color=color, ls=ls, label=label)
+
+
+def profile_ellipses(df, filt, median=True, kron=True, petrosian=True,
+                     exp=False, sersic=True, voculer=False):
+    """
+    Pixel geometry of the fitted profiles for every row of {df}
+
+    Returns list of (a, b, theta, color, label, ls), where a, b
+    (semi-axes in pixels) and theta (degrees) are arrays
+    """
+    def col(name):
+        return df[filt + name].values.astype(float)
+
+    zeros = np.zeros(len(df))
+    overlays = []
+    if median:
+        overlays.append((col("GalMajor")*PANPARS.scale/2, col("GalMinor")*PANPARS.scale/2,
+                         col("GalPhi"), 'red', 'sectormedian', '-'))
+    if kron:
+        kronrad = col("KronRad")*PANPARS.scale
+        overlays.append((kronrad, kronrad, zeros, 'yellow', 'Kron', '--'))
+    if sersic:
+        sera = col("SerRadius")*PANPARS.scale
+        overlays.append((sera, sera*col("SerAb"), col("SerPhi"), 'orange', 'Sersic', '-'))
+    if exp:
+        expa = col("ExpRadius")*PANPARS.scale
+        overlays.append((expa, expa*col("ExpAb"), col("ExpPhi"), 'green', 'Exp', '-'))
+    if voculer:
+        deva = col("ExpRadius")*PANPARS.scale
+        overlays.append((deva, deva*col("ExpAb"), col("ExpPhi"), 'blue', 'Voculer', '-'))
+    if petrosian:
+        petrorad = col("petRadius")
+        overlays.append((petrorad, petrorad, zeros, 'yellowgreen', 'Petro', '--'))
+    return overlays
+
+
+def _download_fits(pos, size, filt, timeout=None, retries=0, backoff=1.):
+    for attempt in range(retries + 1):
+        try:
+            fitsurl = geturl(*pos, size=size, filters=filt, format="fits",
+                             timeout=timeout)
+            r = session().get(fitsurl[0], timeout=timeout)
+            r.raise_for_status()
+            return fits.open(BytesIO(r.content))[0]
+        except (requests.RequestException, OSError):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def _storable(hdu):
+    """
+    float32 pixels and header of hdu, ready for the cutout store
+    """
+    header = hdu.header.copy()
+    # pixels are stored already scaled
+    for kw in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(kw, ignore_missing=True)
+    return np.asarray(hdu.data, dtype=np.float32), header
+
+
+def _cutout_key(pos, size, filt, kind="cutout"):
+    # 1e-7 deg is well below a pixel, but absorbs float noise in positions
+    ra, dec = pos
+    return ArrayStore.key(kind, round(float(ra), 7), round(float(dec), 7),
+                          int(size), filt)
+
+
+def _hdu_from_store(entry):
+    data, meta = entry
+    return fits.PrimaryHDU(data=data, header=fits.Header.fromstring(meta['header']))
+
+
+def _fetch_cutout(pos, size, filt, timeout=None, retries=0, backoff=1.):
+    """
+    Cutout from the store, downloaded and stored on a miss
+    """
+    key = _cutout_key(pos, size, filt)
+    entry = cutouts.get(key)
+    if entry is not None:
+        return _hdu_from_store(entry)
+
+    hdu = _download_fits(pos, size, filt, timeout=timeout, retries=retries, backoff=backoff)
+    data, header = _storable(hdu)
+    return _hdu_from_store(cutouts.put(key, data, {'header': header.tostring()}))
+
+
+def _align(data, header, ref, shape):
+    """
+    Resample image onto the pixel grid of ref wcs with given shape
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        wcs = WCS(header, naxis=2, fix=False)
+    # where pixel (0, 0) of this image falls on the reference grid
+    dx, dy = ref.all_world2pix(wcs.all_pix2world([[0, 0]], 0), 0)[0]
+    if data.shape == shape and abs(dx) < 1e-3 and abs(dy) < 1e-3:
+        return data
+    return affine_transform(data, np.eye(2), offset=(-dy, -dx), output_shape=shape,
+                            order=1, cval=np.nan)
+
+
+def getcube(pos, size, filters="grizy", timeout=None, retries=0, backoff=1.):
+    """
+    Cutouts at {pos} (in degrees) of {size} pixels in all {filters} at once
+
+    Bands are downloaded concurrently and resampled onto the pixel grid
+    of the first one. The (band, y, x) float32 cube is kept in `cutouts`
+    store and returned as a read-only memory map.
+
+    Returns
+    -------
+    cube: `numpy.memmap`
+        bands in order of {filters}
+    header: `astropy.io.fits.Header`
+        header of the first band, with WCS of every plane
+    """
+    key = _cutout_key(pos, size, filters, kind="cube")
+    entry = cutouts.get(key)
+    if entry is None:
+        with ThreadPoolExecutor(max_workers=len(filters)) as pool:
+            hdus = list(pool.map(
+                lambda f: _download_fits(pos, size, f, timeout=timeout,
+                                         retries=retries, backoff=backoff),
+                filters))
+        planes, headers = zip(*map(_storable, hdus))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            ref = WCS(headers[0], naxis=2, fix=False)
+        cube = np.stack([_align(data, header, ref, planes[0].shape)
+                         for data, header in zip(planes, headers)])
+        header = headers[0].copy()
+        header['BANDS'] = filters
+        entry = cutouts.put(key, cube.astype(np.float32),
+                            {'header': header.tostring(), 'filters': filters})
+    data, meta = entry
+    return data, fits.Header.fromstring(meta['header'])
+
+
 def getfits(pos, size, name, filt):
-    fitsurl = geturl(*pos, size=size, filters=filt, format="fits")
-    print(fitsurl)
-    hdu = fits.open(fitsurl[0])[0]
-    return hdu.copy()
+    """
+    Fits cutout of {size} pixels at {pos} (in degrees) in {filt} band
+
+    Pixels are kept in `cutouts` store as float32, on a hit the returned
+    HDU holds a read-only memory map of the stored array.
+    {name} is not used and kept for compatibility.
+    """
+    return _fetch_cutout(pos, size, filt)
+
+
+def fetch_fits_many(wanted, nworkers=8, timeout=60, retries=3, backoff=1.,
+                    progress=None):
+    """
+    Download many fits cutouts concurrently
+
+    Parameters
+    ----------
+    wanted: iterable of `tuple`
+        (pos, size, filt) requests, as for `getfits`;
+        cutouts found in the store are not downloaded again
+    nworkers: `int`
+        maximal number of requests in flight
+    timeout: `float`
+        seconds to wait for every single http request
+    retries: `int`
+        how many times to retry a failed cutout, waiting
+        backoff, 2*backoff, 4*backoff... seconds in between
+    progress: callable
+        called as progress(ndone, ntotal) after every finished cutout
+
+    Returns
+    -------
+    hdus: `dict`
+        (pos, size, filt) -> `PrimaryHDU` for successful downloads
+    report: `Namespace`
+        `done`, `failed` (request -> exception) and `elapsed` seconds
+    """
+    wanted = [(tuple(pos), size, filt) for pos, size, filt in wanted]
+    hdus, failed = {}, {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        futures = {
+            pool.submit(_fetch_cutout, *cutout, timeout, retries, backoff): cutout
+            for cutout in wanted
+        }
+        for ndone, future in enumerate(as_completed(futures), 1):
+            cutout = futures[future]
+            try:
+                hdus[cutout] = future.result()
+            except Exception as e:
+                failed[cutout] = e
+            if progress is not None:
+                progress(ndone, len(wanted))
+
+    report = Namespace(done=len(hdus), failed=failed,
+                       elapsed=time.perf_counter() - start)
+    return hdus, report
 
 
 def plot_panstarrs(center, size, name, filt, df, ref=None,
@@ -139,13 +436,10 @@ def plot_panstarrs(center, size, name, filt, df, ref=None,
             warnings.simplefilter("ignore")
             wcs = WCS(hdu.header, fix=False)
 
-        # print(wcs)
-        im = hdu.data
-        # nan to zeros
-        im[np.isnan(im)] = 0.0
-
-        # set contrast to something reasonable
-        im_sane = transform(im)
+        # set contrast to something reasonable,
+        # nans become zeros, the stored cutout is not modified
+        im_sane = display_image(hdu.data, transform,
+                                key=_cutout_key(center, size, filt))
 
     else:
         # generate a fake WCS
@@ -158,11 +452,11 @@ def plot_panstarrs(center, size, name, filt, df, ref=None,
         wcs.wcs.pc = [[-1, 0], [0, 1]]
         wcs.wcs.latpole = -30
 
-    ax = plt.subplot(subplotindex, projection=wcs)
+    ax = fig.add_subplot(subplotindex, projection=wcs)
     ax.set_title(name)
 
     if image:
-        ax.imshow(im_sane, cmap="bone", origin="lower")
+        ax.imshow(im_sane, cmap="bone", origin="lower", vmin=0, vmax=255)
     else:
         ax.imshow(np.zeros((size, size)))
 
@@ -180,57 +474,19 @@ def plot_panstarrs(center, size, name, filt, df, ref=None,
         panstarrs_src = wcs.all_world2pix(df[['raMean', 'decMean']].values, 0)
         ax.scatter(*panstarrs_src.T, color='yellow', marker='*')
 
-    for i in range(len(df)):
-        row = df.iloc[i:i+1]
-
-        number = row.index[0]
-        row = row.iloc[0]
-        x, y = panstarrs_src[i]
-        name = row['objName']
-
-        ax.annotate(number, xy=(x, y),
-                    xytext=(10, 0), textcoords="offset points",
-                    va="center", ha="left",
-                    bbox=dict(boxstyle="round", fc="w", alpha=0.8))
-
-        if median:
-            a, b = row[[f"{filt}GalMajor", f"{filt}GalMinor"]]*PANPARS.scale/2
-            PA = row[f"{filt}GalPhi"]
-            # n = row[f"{filt}GalIndex"]
-            place_ellipse(a, b, (x, y), PA, 'red', 'sectormedian', ax=ax,
-                          labels_cache=labels_cache)
-        if kron:
-            kronrad = row[f"{filt}KronRad"]*PANPARS.scale
-            place_ellipse(kronrad, kronrad, (x, y), PA, 'yellow', 'Kron', ax=ax,
-                          ls='--',
-                          labels_cache=labels_cache)
-        if sersic:
-            sera = row[f"{filt}SerRadius"]*PANPARS.scale
-            serab = row[f"{filt}SerAb"]
-            serb = sera * serab
-            serPA = row[f"{filt}SerPhi"]
-            place_ellipse(sera, serb, (x, y), serPA, 'orange', 'Sersic', ax=ax,
-                          labels_cache=labels_cache)
-        if exp:
-            expa = row[f"{filt}ExpRadius"]*PANPARS.scale
-            expab = row[f"{filt}ExpAb"]
-            expb = expa * expab
-            expPA = row[f"{filt}ExpPhi"]
-            place_ellipse(expa, expb, (x, y), expPA, 'green', 'Exp', ax=ax,
-                          labels_cache=labels_cache)
-        if voculer:
-            deva = row[f"{filt}ExpRadius"]*PANPARS.scale
-            devab = row[f"{filt}ExpAb"]
-            devb = deva * devab
-            devPA = row[f"{filt}ExpPhi"]
-            place_ellipse(deva, devb, (x, y), devPA, 'blue', 'Voculer', ax=ax,
-                          labels_cache=labels_cache)
-        if petrosian:
-            petrorad = row[f"{filt}petRadius"]
-            place_ellipse(petrorad, petrorad, (x, y), 0, 'yellowgreen', 'Petro', ax=ax,
-                          ls='--', labels_cache=labels_cache)
+        for number, (x, y) in zip(df.index, panstarrs_src):
+            ax.annotate(number, xy=(x, y),
+                        xytext=(10, 0), textcoords="offset points",
+                        va="center", ha="left",
+                        bbox=dict(boxstyle="round", fc="w", alpha=0.8))
+
+        overlays = profile_ellipses(df, filt, median=median, kron=kron,
+                                    petrosian=petrosian, exp=exp,
+                                    sersic=sersic, voculer=voculer)
+        for a, b, theta, color, label, ls in overlays:
+            place_ellipses(a, b, panstarrs_src, theta, color, label, ls=ls, ax=ax)
         # if eff: place_ellipse(reff, reff, (x,y), PA, 'green', '$R_e$ (L/2)', ax=ax, ls='--') 
-    plt.legend()
+    ax.legend()
     return ax
 
     
@@ -250,7 +506,7 @@ def ref_from_rfgc(sample):
 
 def show_galaxy_rfgc(
     sample, filt, df=None, sortby=None, zoom=1,
-    jobs=None, template=None, **kwargs
+    jobs=None, template=None, store=None, **kwargs
 ):
     ref = ref_from_rfgc(sample)
     size = 2 * int(ref["a"] * PANPARS.scale)
@@ -260,12 +516,14 @@ def show_galaxy_rfgc(
 
     if df is None and jobs is not None and template is not None:
         df = cone_galaxy_search(
-            jobs, template, (ref["ra"], ref["dec"]), size_arcmin, filt
+            jobs, template, (ref["ra"], ref["dec"]), size_arcmin, filt,
+            store=store
         )
         print(df.T)
     if sortby is not None:
         df = df.sort_values(by=sortby, ascending=False)
-    df.index = range(1, len(df) + 1)
+    # results of cone searches are shared with the cache
+    df = df.set_axis(range(1, len(df) + 1))
 
     plot_panstarrs(
         (ref["ra"], ref["dec"]),
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    code.display
+    ~~~~~~~~~~~~
+
+    Preparation of cutouts for display
+
+    Percentile interval limits are estimated on a strided subsample of
+    the image, other intervals (min/max) look at all of it. The stretch is
+    done in float32 on a copy, and the 8-bit result is cached per
+    (cutout, stretch).
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from astropy.visualization import ManualInterval, AsymmetricPercentileInterval, ZScaleInterval
+from astropy.visualization.interval import BaseInterval
+from astropy.visualization.transform import CompositeTransform
+
+previews = OrderedDict()
+PREVIEWS_MAX = 256
+
+
+def _flatten(transform):
+    """
+    Transforms of a composite in order of application
+    """
+    if isinstance(transform, CompositeTransform):
+        return _flatten(transform.transform_1) + _flatten(transform.transform_2)
+    return [transform]
+
+
+def transform_key(transform):
+    """
+    Hashable description of a (composite) stretch
+    """
+    return tuple(
+        (type(t).__name__, tuple(sorted((k, repr(v)) for k, v in vars(t).items())))
+        for t in _flatten(transform)
+    )
+
+
+def subsample(im, nsample=100000):
+    """
+    Strided subsample of about nsample pixels, NaNs set to zero
+
+    For a percentile p the rank error of limits estimated on it
+    is about sqrt(p*(1-p)/nsample), i.e. ~2e-4 for 99.5% and 1e5 pixels
+    """
+    flat = np.ravel(im)
+    step = max(1, flat.size // nsample)
+    return np.nan_to_num(flat[::step].astype(np.float32))
+
+
+# intervals that are statistical estimates anyway
+SAMPLED_INTERVALS = (AsymmetricPercentileInterval, ZScaleInterval)
+
+
+def fix_limits(transform, sample, im=None):
+    """
+    Chain of transforms with intervals replaced by fixed limits
+
+    Limits of `SAMPLED_INTERVALS` are found on sample, of other
+    intervals on the whole image im (when given), as subsample
+    can miss the extremes.
+    """
+    chain, full = [], None
+    for t in _flatten(transform):
+        if isinstance(t, BaseInterval):
+            if isinstance(t, SAMPLED_INTERVALS) or im is None:
+                t = ManualInterval(*t.get_limits(sample))
+            else:
+                if full is None:
+                    full = np.array(im, dtype=np.float32)
+                    for prev in chain:
+                        prev(full, out=full)
+                t = ManualInterval(*t.get_limits(full))
+        sample = t(sample)
+        if full is not None:
+            t(full, out=full)
+        chain.append(t)
+    return chain
+
+
+def display_image(im, transform, key=None, nsample=100000):
+    """
+    uint8 image stretched with transform, the source is left intact
+
+    key -- identifies the cutout, previews with a key are cached
+    """
+    if key is not None:
+        ckey = (key, transform_key(transform))
+        if ckey in previews:
+            previews.move_to_end(ckey)
+            return previews[ckey]
+
+    chain = fix_limits(transform, subsample(im, nsample), im)
+    work = np.nan_to_num(np.array(im, dtype=np.float32))
+    for t in chain:
+        t(work, out=work)
+    preview = (work*255 + 0.5).astype(np.uint8)
+    preview.flags.writeable = False
+
+    if key is not None:
+        previews[ckey] = preview
+        if len(previews) > PREVIEWS_MAX:
+            previews.popitem(last=False)
+    return preview
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    code.ellmatch
+    ~~~~~~~~~~~~~
+
+    Match detections against a whole catalog of galaxy ellipses
+
+    Detections are processed in chunks: a KD-tree of the chunk on the unit
+    sphere gives candidates within the bounding radius of every ellipse,
+    candidates are then tested with the exact rotated ellipse.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from .skycache import radec2xyz
+
+
+def elliptical_radius(ra, dec, ra0, dec0, theta, a, b):
+    """
+    Normalized elliptical radius of points, 1 on the ellipse
+
+    positions in degrees, a and b in arcsec,
+    theta in the same convention as `crosstools.inellipse`
+    """
+    x = ((ra - ra0 + 180) % 360 - 180) * np.cos(np.radians(dec0)) * 3600
+    y = (dec - dec0) * 3600
+    c = np.cos(np.radians(theta))
+    s = np.sin(np.radians(theta))
+    u = x*c - y*s
+    v = x*s + y*c
+    return np.sqrt((u/a)**2 + (v/b)**2)
+
+
+def _match_chunk(det_xyz, start, ell_xyz, chord, workers):
+    tree = cKDTree(det_xyz)
+    candidates = tree.query_ball_point(ell_xyz, chord, workers=workers)
+    counts = np.fromiter(map(len, candidates), dtype=int, count=len(candidates))
+    galaxy = np.repeat(np.arange(len(candidates)), counts)
+    if counts.sum() == 0:
+        return galaxy, galaxy.copy()
+    return np.concatenate(candidates).astype(int) + start, galaxy
+
+
+def match_ellipses(ra, dec, ellipses, qmax=1., chunksize=2**18, njobs=None):
+    """
+    Find all (detection, galaxy) pairs with detection inside galaxy ellipse
+
+    Parameters
+    ----------
+    ra, dec: `numpy.ndarray`
+        detections, in degrees
+    ellipses: mapping
+        `ra`, `dec`, `PA` (degrees), `a`, `b` (arcsec) of galaxies,
+        like `crosstools.ref_from_rfgc` gives for the RFGC table
+    qmax: `float`
+        limit on normalized elliptical radius
+    chunksize: `int`
+        detections per KD-tree, bounds the memory used
+    njobs: `int`
+        threads to use, all cores by default
+
+    Returns
+    -------
+    pairs: `pandas.DataFrame`
+        `detection` and `galaxy` (positional indices into inputs) and
+        normalized elliptical radius `q`
+    """
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+    ell = {k: np.asarray(ellipses[k], dtype=float) for k in ('ra', 'dec', 'PA', 'a', 'b')}
+    njobs = os.cpu_count() if njobs is None else njobs
+
+    ell_xyz = radec2xyz(ell['ra'], ell['dec'])
+    bound = np.radians(qmax * np.maximum(ell['a'], ell['b']) / 3600)
+    chord = 2*np.sin(bound/2)
+
+    def work(start):
+        stop = min(start + chunksize, len(ra))
+        det_xyz = radec2xyz(ra[start:stop], dec[start:stop])
+        det, gal = _match_chunk(det_xyz, start, ell_xyz, chord, workers=1)
+        q = elliptical_radius(ra[det], dec[det], ell['ra'][gal], ell['dec'][gal],
+                              ell['PA'][gal], ell['a'][gal], ell['b'][gal])
+        inside = q < qmax
+        return det[inside], gal[inside], q[inside]
+
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        parts = list(pool.map(work, range(0, len(ra), chunksize)))
+
+    if len(parts) == 0:
+        parts = [(np.zeros(0, int), np.zeros(0, int), np.zeros(0))]
+    det, gal, q = (np.concatenate(p) for p in zip(*parts))
+    return pd.DataFrame({'detection': det, 'galaxy': gal, 'q': q})
@@ -8,15 +8,20 @@
     expand loop-like templates in sql queries
     see .tsql files in queries directory for examples
 
+    A template is compiled once into a tree of text pieces and loops,
+    rendering it with other parameters only walks the tree and joins
+    the output fragments.
+
     :copyright: (c) 2019 by taxus-d.
     :license: MIT, see LICENSE for more details.
 """
 
+import os
 import string
 import re
+from collections import namedtuple
+from functools import lru_cache
 
-import pandas as pd  # required by another part of project anyway
-import numpy as np
 import yaml
 
 
@@ -37,131 +42,297 @@ _statregexes = {
     'end'       : re.compile(r"--\s*end\s*--")
 }
 
+# indent, variable and list are kept as written, the list is
+# formatted with parameters and parsed as yaml at rendering
+Loop = namedtuple("Loop", ["indent", "variable", "values", "body"])
+
+
+def tokenize(t):
+    """
+    Loop statements of template in order of appearance
+
+    Returns list of (type, match), type is 'loop start' or 'end'
+    """
+    tokens = [(typ, m) for typ, rx in _statregexes.items() for m in rx.finditer(t)]
+    tokens.sort(key=lambda tok: tok[1].start())
+    return tokens
+
+
+def _build_tree(t, tokens):
+    """
+    Nested list of text pieces and `Loop`s
+    """
+    root = []
+    stack = []  # (loop start match, parent node list)
+    nodes, cpos = root, 0
+    for typ, m in tokens:
+        nodes.append(t[cpos:m.start()])
+        cpos = m.end()
+        if typ == 'loop start':
+            stack.append((m, nodes))
+            nodes = []
+        else:
+            if not stack:
+                raise SyntaxError(
+                    "`end' without a loop at position {}, check template throughly"
+                    .format(m.start()))
+            start, parent = stack.pop()
+            parent.append(Loop(start[1], start[2], start[3], nodes))
+            nodes = parent
+    if stack:
+        raise SyntaxError(
+            "loop at position {} has no `end', check template throughly"
+            .format(stack[-1][0].start()))
+    nodes.append(t[cpos:])
+    return root
+
+
+@lru_cache(maxsize=128)
+def compile_template(t):
+    """
+    Tree of template text t, cached by the text
+    """
+    return _build_tree(t, tokenize(t))
+
+
+_loaded = {}
+
 
-def _trim_body_sniff_comma(body):
+def load_template(path):
     """
-    detect and trim comma at the end of sting if it is present
+    Compiled template from file, recompiled when the file changes
     """
-    trimmer = re.compile(r"(,?)\s+$")
-    has_comma = False
-    if "," in re.findall(trimmer, body):
-        has_comma = True
-    body_trimmed = re.sub(trimmer, "", body)
-    return body_trimmed, has_comma
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _loaded[path] = (mtime, compile_template(f.read()))
+    return cached[1]
 
 
-def handle_loops(s, stats, sb, se, level):
+@lru_cache(maxsize=1024)
+def _parse_list(text):
+    values = yaml.load(text, yaml.SafeLoader)
+    return tuple(values) if values is not None else ()
+
+
+def _loop_values(loop, mapping):
+    return _parse_list(_formatter.vformat(loop.values, (), mapping))
+
+
+@lru_cache(maxsize=4096)
+def _parse_format(text):
+    """
+    Literal text and replacement fields of a format string
+    """
+    return tuple(_formatter.parse(text))
+
+
+def _bind(nodes, mapping):
     """
-    Expand all loops
+    Substitute parameters into compiled template once,
+    text pieces become pre-parsed format segments
+    """
+    bound = []
+    for node in nodes:
+        if isinstance(node, str):
+            bound.append(_parse_format(_formatter.vformat(node, (), mapping)))
+        else:
+            bound.append(Loop(_formatter.vformat(node.indent, (), mapping),
+                              node.variable, _loop_values(node, mapping),
+                              _bind(node.body, mapping)))
+    return bound
+
+
+def _emit_text(segments, env, out):
+    for literal, field, spec, conversion in segments:
+        if literal:
+            out.append(literal)
+        if field is None:
+            continue
+        if spec and "{" in spec:
+            spec = _formatter.vformat(spec, (), env)
+        obj, _ = _formatter.get_field(field, (), env)
+        obj = _formatter.convert_field(obj, conversion)
+        out.append(_formatter.format_field(obj, spec))
+
+
+def _trim_tail(out, mark):
+    """
+    Trim trailing whitespace and a comma just before it
+    from the fragments of out after mark (loop body)
+    """
+    trimmed = False
+    while len(out) > mark:
+        stripped = out[-1].rstrip()
+        trimmed = trimmed or stripped != out[-1]
+        if stripped:
+            out[-1] = stripped
+            break
+        out.pop()
+    if trimmed and len(out) > mark and out[-1].endswith(","):
+        out[-1] = out[-1][:-1]
+
+
+def handle_loops(nodes, env, out, level=0):
+    """
+    Expand all loops of bound template, appending fragments to out
     The main routine in hmte currently
 
-    May be generalized to arbitary structure handler in distant future
-    """
-    if len(stats) > 0:
-        bottomstats = stats.loc[stats['level'] == level]
-        begins = bottomstats.iloc[range(0, len(bottomstats), 2)]
-        ends = bottomstats.iloc[range(1, len(bottomstats), 2)]
-        try:
-            assert len(begins) == len(ends)
-            assert np.all(ends.type == 'end')
-        except AssertionError:
-            raise SyntaxError(
-                """your `begins' dont match your `ends', check template throughly
-                """)
-
-        rep_body = ""
-        cpos = sb
-
-        for i in range(len(begins)):
-            b, e = begins.iloc[i], ends.iloc[i]
-
-            grs = _statregexes['loop start'].fullmatch(s[b.beg:b.end])
-
-            indent = grs[1]
-            loop_variable = grs[2]
-            lis = yaml.load(grs[3], yaml.SafeLoader)
-
-            idx_start = begins.index[i]
-            idx_stop  = ends.index[i]
-
-            # recurse !
-            # (loops can be arbitary nested)
-            body = handle_loops(s, stats.loc[idx_start+1:idx_stop-1],
-                                b.end, e.beg, level+1)
-
-            rep_body += s[cpos:b.beg]
-
-            for i in range(len(lis)):
-                v = lis[i]
-                body_trimmed, has_comma_at_end = _trim_body_sniff_comma(body)
-                optcomma = "," if (i < len(lis)-1 or level > 0) else ""
-                optcaret = indent  # if i > 0 else ""
-                # matching formatting is always tricky...
-
-                mapping = FormatDict(**{loop_variable: v})
-                rep_body += optcaret + _formatter.vformat(body_trimmed, (), mapping) + optcomma
-            cpos = e.end
-        rep_body += s[cpos:se]
-    else:
-        rep_body = s[sb:se]
-    return rep_body
-
-
-def find_loops(s, stats):
-    loopstarts = re.finditer(_statregexes['loop start'], s)
-    newrows = []
-    for stat in loopstarts:
-        newrows.append({
-            "beg": stat.span()[0],
-            "end": stat.span()[1],
-            "type": "loop start"
-        })
-    if newrows == []:
-        return stats
-    else:
-        return stats.append(newrows, ignore_index=True)
-
-
-def find_ends(s, stats):
-    ends = re.finditer(_statregexes['end'], s)
-    newrows = []
-    for stat in ends:
-        newrows.append({
-            "beg": stat.span()[0],
-            "end": stat.span()[1],
-            "type": "end"
-        })
-    if newrows == []:
-        return stats
-    else:
-        return stats.append(newrows, ignore_index=True)
-
-
-def assign_levels(stats):
-    stats.level = 0
-    currentlevel = 0
-    for i in range(len(stats)):
-        t = stats.loc[i]["type"]
-        if t in ("loop start"):
-            stats.loc[i, "level"] = currentlevel
-            currentlevel += 1
-        elif t in ("end"):
-            currentlevel -= 1
-            stats.loc[i, "level"] = currentlevel
-    return stats
-
-
-def expand_templates(t, **kw):
-    mapping = FormatDict(**kw)
-    query_ws = _formatter.vformat(t, (), mapping)
-
-    s = query_ws
-    stats = pd.DataFrame(columns=["beg", "end", "type", "level"])
-
-    stats = find_loops(s, stats)
-    stats = find_ends(s, stats)
-    stats = stats.sort_values(by="beg")
-    stats.index = range(len(stats))
-    stats = assign_levels(stats)
-    query = handle_loops(s, stats, 0, len(s), 0)
+    Parameters are substituted before loop variables (see `_bind`),
+    inner loop variables before outer ones. Every piece of the template
+    is visited once per output fragment, so the cost is linear in output.
+    """
+    for node in nodes:
+        if not isinstance(node, Loop):
+            _emit_text(node, env, out)
+            continue
+
+        lis = node.values
+        loopenv = FormatDict(env)
+        for i in range(len(lis)):
+            out.append(node.indent)
+            mark = len(out)
+            loopenv[node.variable] = lis[i]
+            handle_loops(node.body, loopenv, out, level+1)
+            # matching formatting is always tricky...
+            _trim_tail(out, mark)
+            if i < len(lis)-1 or level > 0:
+                out.append(",")
+    return out
+
+# projection pushdown
+# -------------------
+
+DETECTION_KEYS = ("objID", "bestDetection", "primaryDetection")
+
+# table -> (pattern of its per band columns, columns always kept for joins)
+TABLE_COLUMNS = {
+    'StackModelFitSer'     : (re.compile(r"[grizy]Ser[A-Z]\w*"), DETECTION_KEYS),
+    'StackModelFitExp'     : (re.compile(r"[grizy]Exp[A-Z]\w*"), DETECTION_KEYS),
+    'StackModelFitDeV'     : (re.compile(r"[grizy]DeV[A-Z]\w*"), DETECTION_KEYS),
+    'StackPetrosian'       : (re.compile(r"[grizy]pet[A-Z]\w*"), DETECTION_KEYS),
+    'StackObjectAttributes': (re.compile(r"[grizy](Kron|psf|ap)[A-Z]\w*"), DETECTION_KEYS),
+    'ForcedGalaxyShape'    : (re.compile(r"[grizy]Gal[A-Z]\w*"), ("objID",)),
+    'MeanObjectView'       : (re.compile(r"[grizy]Mean[A-Z]\w*"), ("objID",)),
+}
+
+# per band names made up in templates, like kron*
+DERIVED_COLUMNS = re.compile(r"[grizy](kron|pet)[A-Z]\w*")
+
+_select_star = re.compile(r"SELECT(\s+)(\w+)\.\*(\s+FROM\s+(\w+)\s+AS\s+(\w+)\b)", re.I)
+_select_item = re.compile(r"\s*(?:\w+\.)?(\w+)(?:\s+AS\s+(\w+))?\s*", re.I)
+_sqlwords = re.compile(r"'(?:[^']|'')*'|--[^\n]*|\(|\)|,|\b(?:SELECT|INTO|FROM)\b", re.I)
+
+
+def expand_columns(columns, filters="grizy"):
+    """
+    Set of column names, patterns like {f}SerRadius are expanded over filters
+    """
+    names = set()
+    for c in columns:
+        if "{f}" in c:
+            names.update(c.replace("{f}", f) for f in filters)
+        else:
+            names.add(c)
+    return names
+
+
+def _band_column(name):
+    return DERIVED_COLUMNS.fullmatch(name) or any(
+        pattern.fullmatch(name) for pattern, _ in TABLE_COLUMNS.values())
+
+
+def _final_select_items(query):
+    """
+    Spans of items in the list of the outermost (last top level) SELECT
+    """
+    depth, items = 0, None
+    for m in _sqlwords.finditer(query):
+        word = m.group().upper()
+        if word == "(":
+            depth += 1
+        elif word == ")":
+            depth -= 1
+        elif depth > 0 or word.startswith(("'", "-")):
+            continue
+        elif word == "SELECT":
+            items, start = [], m.end()
+        elif word == "," and items is not None:
+            items.append((start, m.start()))
+            start = m.end()
+        elif word in ("INTO", "FROM") and items is not None:
+            items.append((start, m.start()))
+            return items
+    return []
+
+
+def _prune_final_select(query, columns):
+    """
+    Drop per band columns which are not in columns from the outermost SELECT
+    """
+    items = _final_select_items(query)
+    if not items:
+        return query
+    kept = []
+    for beg, end in items:
+        m = _select_item.fullmatch(query, beg, end)
+        name = m and (m[2] or m[1])
+        if m is None or name in columns or not _band_column(name):
+            kept.append(query[beg:end])
+    if not kept:
+        raise ValueError("none of the requested columns is in the query")
+    tail = query[items[-1][0]:items[-1][1]]
+    trailing = tail[len(tail.rstrip()):]
+    return (query[:items[0][0]] + ",".join(kept).rstrip() + trailing
+            + query[items[-1][1]:])
+
+
+def project(query, columns):
+    """
+    Narrow query to the columns it needs for the requested ones
+
+    The outermost SELECT loses per band columns not in columns,
+    `SELECT a.* FROM Table AS a` of tables known in `TABLE_COLUMNS`
+    lists only their keys, requested columns and columns used
+    anywhere else in the query.
+    """
+    query = _prune_final_select(query, columns)
+    used = set(re.findall(r"\w+", _select_star.sub("", query)))
+
+    def expand(m):
+        if m[2] != m[5] or m[4] not in TABLE_COLUMNS:
+            return m.group()
+        pattern, keys = TABLE_COLUMNS[m[4]]
+        names = list(keys) + sorted(
+            c for c in (columns | used) - set(keys) if pattern.fullmatch(c))
+        return "SELECT" + m[1] + ", ".join(m[2] + "." + c for c in names) + m[3]
+
+    return _select_star.sub(expand, query)
+
+
+# parameters callers may leave out, e.g. the shard condition
+# of templates runnable in shards (see `sharding`)
+DEFAULTS = {'shardwhere': ""}
+
+
+def render(template, **kw):
+    """
+    Expand compiled template with parameters kw, missing ones from `DEFAULTS`
+    """
+    mapping = FormatDict(DEFAULTS, **kw)
+    return "".join(handle_loops(_bind(template, mapping), FormatDict(), []))
+
+
+def expand_templates(t, columns=None, **kw):
+    """
+    Expand template text t with parameters kw
+
+    columns -- if given, query only what is needed for them (see `project`),
+               patterns like {f}SerRadius are expanded over grizy
+    """
+    query = render(compile_template(t), **kw)
+    if columns is not None:
+        query = project(query, expand_columns(columns))
     return query
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    code.jobmanager
+    ~~~~~~~~~~~~~~~
+
+    Long queue CasJobs jobs for expanded templates, run with asyncio
+
+    Every job has a name, the MyDB table its query writes INTO. Job ids
+    and statuses are kept in a JSON state file, so a session started
+    again with the same file polls jobs already submitted instead of
+    submitting them anew, and skips results already downloaded.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import time
+import asyncio
+from argparse import Namespace
+from pathlib import Path
+
+from .crosstools import PANPARS
+from .sharding import FINISHED, JobFailed
+from .tablestore import SUFFIX, replace_sentinels, compact, read_table, write_table
+
+# CasJobs job status codes
+CANCELLED, FAILED = 3, 4
+
+
+class JobManager:
+    """
+    jobs      -- `mastcasjobs.MastCasJobs` or anything with submit, status,
+                 get_table, drop_table and drop_table_if_exists
+    statefile -- JSON file with the state of jobs
+    outdir    -- where downloaded tables go, next to statefile by default
+    poll      -- seconds between status requests of a job
+    maxjobs   -- maximal number of jobs in the queue at once
+    retries   -- how many times a job is retried in one run: resubmitted
+                 if it failed on the server, polled or downloaded again
+                 after other errors, waiting poll*2**attempt in between
+    columns   -- column set to keep in downloaded tables (see `tablestore`)
+    """
+    def __init__(self, jobs, statefile, outdir=None, context="PanSTARRS_DR2",
+                 poll=10., maxjobs=8, retries=2, columns=None):
+        self.jobs = jobs
+        self.statefile = Path(statefile)
+        self.outdir = Path(outdir) if outdir is not None else self.statefile.parent
+        self.context = context
+        self.poll = poll
+        self.maxjobs = maxjobs
+        self.retries = retries
+        self.columns = columns
+        self.state = {}
+        if self.statefile.exists():
+            with open(self.statefile) as f:
+                self.state = json.load(f)
+
+    def save(self):
+        self.statefile.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.statefile.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1)
+        tmp.replace(self.statefile)
+
+    def add(self, name, query):
+        """
+        Register query writing INTO name, a known job with the same query is kept
+        """
+        job = self.state.get(name)
+        if job is None or job['query'] != query:
+            self.state[name] = dict(query=query, jobid=None, status="new",
+                                    attempts=0, error=None)
+            self.save()
+
+    def add_many(self, named_queries):
+        """
+        Register (name, query) pairs, e.g. from `sharding.shard_queries`
+        """
+        for name, query in named_queries:
+            self.add(name, query)
+
+    def path(self, name):
+        return self.outdir / (name + SUFFIX)
+
+    def load(self, name):
+        """
+        Downloaded result of job name
+        """
+        return read_table(self.path(name), self.columns)
+
+    def pending(self):
+        return [name for name, job in self.state.items()
+                if job['status'] != "downloaded" or not self.path(name).exists()]
+
+    async def _submit(self, name):
+        job = self.state[name]
+        job['attempts'] += 1
+        self.save()
+        # leftovers of a failed attempt would break INTO
+        await asyncio.to_thread(self.jobs.drop_table_if_exists, name)
+        job['jobid'] = await asyncio.to_thread(
+            self.jobs.submit, job['query'], context=self.context, task_name=name)
+        job['status'] = "submitted"
+        job['submitted'] = time.time()
+        self.save()
+
+    async def _wait(self, name):
+        job = self.state[name]
+        while True:
+            code, status = await asyncio.to_thread(self.jobs.status, job['jobid'])
+            if code in (FINISHED, CANCELLED, FAILED):
+                return code, status
+            await asyncio.sleep(self.poll)
+
+    async def _download(self, name):
+        result = await asyncio.to_thread(self.jobs.get_table, name)
+
+        def store():
+            df = compact(replace_sentinels(result.to_pandas(), PANPARS.defaultvalue))
+            self.outdir.mkdir(parents=True, exist_ok=True)
+            tmp = self.path(name).with_suffix(".tmp")
+            write_table(df, tmp, self.columns)
+            tmp.replace(self.path(name))
+
+        await asyncio.to_thread(store)
+        await asyncio.to_thread(self.jobs.drop_table, name)
+
+    async def _run(self, name, slots):
+        job = self.state[name]
+        async with slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    if job['jobid'] is None or job['status'] == "failed":
+                        await self._submit(name)
+                    if job['status'] == "submitted":
+                        code, status = await self._wait(name)
+                        if code != FINISHED:
+                            job['status'] = "failed"
+                            raise JobFailed("job {} ended as {}".format(job['jobid'], status))
+                        job['status'] = "finished"
+                        self.save()
+                    await self._download(name)
+                    job['status'], job['error'] = "downloaded", None
+                    self.save()
+                    return
+                except Exception as e:
+                    # only a job failed on the server is submitted again,
+                    # after other errors (polling, download) the same job
+                    # is looked at again
+                    job['error'] = repr(e)
+                    self.save()
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(self.poll * 2**attempt)
+
+    async def run_async(self, progress=None):
+        """
+        Submit, wait for and download all pending jobs
+
+        progress -- called as progress(ndone, ntotal) after every finished job
+        Returns report `Namespace` with `done`, `failed`
+        (name -> exception) and `elapsed` seconds
+        """
+        start = time.perf_counter()
+        names = self.pending()
+        slots = asyncio.Semaphore(self.maxjobs)
+        failed, done = {}, 0
+
+        async def one(name):
+            nonlocal done
+            try:
+                await self._run(name, slots)
+            except Exception as e:
+                failed[name] = e
+            done += 1
+            if progress is not None:
+                progress(done, len(names))
+
+        await asyncio.gather(*(one(name) for name in names))
+        return Namespace(done=len(names) - len(failed), failed=failed,
+                         elapsed=time.perf_counter() - start)
+
+    def run(self, progress=None):
+        """
+        `run_async` for code outside of an event loop
+        """
+        return asyncio.run(self.run_async(progress))
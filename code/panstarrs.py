@@ -7,39 +7,75 @@ https://ps1images.stsci.edu/ps1image.html
 
 
 from __future__ import print_function
+import asyncio
 import numpy
 import requests
-from PIL import Image
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from PIL import ImageFile
 
 from astropy.table import Table
 
+from .skycells import getimages_local
+
 
 # Python 3.x
 #  from urllib.parse import quote as urlencode
 #  from urllib.request import urlretrieve
 #  import http.client as httplib
 
+# base of ps1filenames.py and fitscut.cgi, may be pointed to a local stand-in
+SERVICE_URL = "https://ps1images.stsci.edu/cgi-bin"
+
+# keep-alive connections kept open to the image server
+POOL_SIZE = 16
+_session = None
+
+
+def session():
+    """Shared requests session with a pool of keep-alive connections"""
+
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def fetchimage(url, timeout=None):
+    """Download jpg or png image at url, decoding it while it streams in"""
+
+    parser = ImageFile.Parser()
+    with session().get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=64*1024):
+            parser.feed(chunk)
+    return parser.close()
+
 
-def getimages(ra, dec, size=240, filters="grizy"):
+def getimages(ra, dec, size=240, filters="grizy", timeout=None):
 
     """Query ps1filenames.py service to get a list of images
 
     ra, dec = position in degrees
     size = image size in pixels (0.25 arcsec/pixel)
     filters = string with filters to include
+    timeout = seconds to wait for the service (default = wait forever)
     Returns a table with the results
     """
 
-    service = "https://ps1images.stsci.edu/cgi-bin/ps1filenames.py"
+    service = SERVICE_URL + "/ps1filenames.py"
     url = ("{service}?ra={ra}&dec={dec}&size={size}&format=fits"
            "&filters={filters}").format(**locals())
-    table = Table.read(url, format='ascii')
+    r = session().get(url, timeout=timeout)
+    r.raise_for_status()
+    table = Table.read(r.text, format='ascii')
     return table
 
 
 def geturl(ra, dec, size=240, output_size=None, filters="grizy", format="jpg",
-           color=False):
+           color=False, timeout=None, local=True):
 
     """Get URL for images in the table
 
@@ -51,6 +87,9 @@ def geturl(ra, dec, size=240, output_size=None, filters="grizy", format="jpg",
     format = data format (options are "jpg", "png" or "fits")
     color = if True, creates a color image (only for jpg or png format).
             Default is return a list of URLs for single-filter grayscale images.
+    timeout = seconds to wait for the filename lookup
+    local = if True, file names are found with `skycells` without asking
+            ps1filenames.py
     Returns a string with the URL
     """
 
@@ -58,9 +97,13 @@ def geturl(ra, dec, size=240, output_size=None, filters="grizy", format="jpg",
         raise ValueError("color images are available only for jpg or png formats")
     if format not in ("jpg", "png", "fits"):
         raise ValueError("format must be one of jpg, png, fits")
-    table = getimages(ra, dec, size=size, filters=filters)
-    url = ("https://ps1images.stsci.edu/cgi-bin/fitscut.cgi?"
-           "ra={ra}&dec={dec}&size={size}&format={format}").format(**locals())
+    if local:
+        table = getimages_local(ra, dec, size=size, filters=filters)
+    else:
+        table = getimages(ra, dec, size=size, filters=filters, timeout=timeout)
+    url = ("{SERVICE_URL}/fitscut.cgi?"
+           "ra={ra}&dec={dec}&size={size}&format={format}").format(
+               SERVICE_URL=SERVICE_URL, **locals())
     if output_size:
         url = url + "&output_size={}".format(output_size)
     # sort filters from red to blue
@@ -97,9 +140,7 @@ def getcolorim(ra, dec, size=240, output_size=None, filters="grizy",
         raise ValueError("format must be jpg or png")
     url = geturl(ra, dec, size=size, filters=filters, output_size=output_size,
                  format=format, color=True)
-    r = requests.get(url)
-    im = Image.open(BytesIO(r.content))
-    return im
+    return fetchimage(url)
 
 
 def getgrayim(ra, dec, size=240, output_size=None, filter="g", format="jpg"):
@@ -120,6 +161,59 @@ def getgrayim(ra, dec, size=240, output_size=None, filter="g", format="jpg"):
         raise ValueError("filter must be one of grizy")
     url = geturl(ra, dec, size=size, filters=filter,
                  output_size=output_size, format=format)
-    r = requests.get(url[0])
-    im = Image.open(BytesIO(r.content))
-    return im
+    return fetchimage(url[0])
+
+
+async def _fetch_many(urlfunc, positions, concurrency, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(ra, dec):
+        async with semaphore:
+            # the lookup of one position overlaps downloads of others
+            url = await asyncio.to_thread(urlfunc, ra, dec)
+            return await asyncio.to_thread(fetchimage, url, timeout)
+
+    return await asyncio.gather(*(one(ra, dec) for ra, dec in positions))
+
+
+async def fetch_color_many(positions, size=240, output_size=None,
+                           filters="grizy", format="jpg", concurrency=8,
+                           timeout=None, local=True):
+    """Get color images at many sky positions concurrently
+
+    positions = iterable of (ra, dec) in degrees
+    concurrency = maximal number of positions processed at once
+    timeout = seconds to wait for every http request
+    other parameters are as in getcolorim and geturl
+    Returns list of images in the order of positions
+    """
+
+    if format not in ("jpg", "png"):
+        raise ValueError("format must be jpg or png")
+
+    def urlfunc(ra, dec):
+        return geturl(ra, dec, size=size, filters=filters, output_size=output_size,
+                      format=format, color=True, timeout=timeout, local=local)
+
+    return await _fetch_many(urlfunc, positions, concurrency, timeout)
+
+
+async def fetch_gray_many(positions, size=240, output_size=None, filter="g",
+                          format="jpg", concurrency=8, timeout=None, local=True):
+    """Get grayscale images at many sky positions concurrently
+
+    positions = iterable of (ra, dec) in degrees
+    other parameters are as in getgrayim and fetch_color_many
+    Returns list of images in the order of positions
+    """
+
+    if format not in ("jpg", "png"):
+        raise ValueError("format must be jpg or png")
+    if filter not in list("grizy"):
+        raise ValueError("filter must be one of grizy")
+
+    def urlfunc(ra, dec):
+        return geturl(ra, dec, size=size, filters=filter, output_size=output_size,
+                      format=format, timeout=timeout, local=local)[0]
+
+    return await _fetch_many(urlfunc, positions, concurrency, timeout)
@@ -12,10 +12,13 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import zlib
+from collections import OrderedDict
+
 from scipy.interpolate import interpn
 from scipy.stats import gaussian_kde
 from scipy.spatial import cKDTree
-from scipy.interpolate import griddata
+from scipy.signal import fftconvolve
 
 import seaborn as sb
 import numpy as np
@@ -28,10 +31,14 @@ import matplotlib as mpl
 
 import plotly.graph_objects as go
 
-from joblib import Memory
+from .arraystore import ArrayStore
 
 cachedir = "./cached/"
-memory = Memory(cachedir, verbose=0)
+
+# results of colorize, in memory and on disk
+colorized = OrderedDict()
+COLORIZED_MAX = 16
+colorized_store = ArrayStore(cachedir + "colorized", maxbytes=2**30)
 
 
 def _colorize_z_none(xx, yy, modepars, plotargs):
@@ -40,9 +47,10 @@ def _colorize_z_none(xx, yy, modepars, plotargs):
     return zz, zlabel, plotargs
 
 
-def _colorize_z_hist(xx, yy, modepars, plotargs):
-    grid = np.vstack([xx, yy])
-    bins = modepars.get('bins', (15, 15))
+def _hist_grid(xx, yy, bins):
+    """
+    2d histogram padded with empty bins, and bin centers
+    """
     h, x_e, y_e = np.histogram2d(xx, yy, bins=bins)
 
     stepx = x_e[1]-x_e[0]
@@ -55,6 +63,13 @@ def _colorize_z_hist(xx, yy, modepars, plotargs):
 
     xc = (x_e[1:] + x_e[:-1])/2
     yc = (y_e[1:] + y_e[:-1])/2
+    return h, xc, yc
+
+
+def _colorize_z_hist(xx, yy, modepars, plotargs):
+    grid = np.vstack([xx, yy])
+    bins = modepars.get('bins', (15, 15))
+    h, xc, yc = _hist_grid(xx, yy, bins)
 
     zz = interpn((xc, yc), h, grid.T, method = "linear")
     zlabel = "interp hist2d"
@@ -70,20 +85,141 @@ def _colorize_z_kde(xx, yy, modepars, plotargs):
     return zz, zlabel, plotargs
 
 
-def _colorize_z_near(xx, yy, modepars, plotargs):
-    scalingx = (np.max(xx) - np.min(xx))
-    scalingy = (np.max(yy) - np.min(yy))
-    xxn = (xx - np.min(xx)) / scalingx
-    yyn = (yy - np.min(yy)) / scalingy
-
-    gridn = np.vstack([xxn, yyn])
-    tree = cKDTree(gridn.T)
-    searchradius = modepars.get('searchradius', 0.05)
-    njobs = modepars.get('njobs', 2)
+def _linear_binning(xx, yy, gridsize):
+    """
+    Spread unit weights of points over the nodes of a regular grid,
+    each to 4 nearest nodes proportionally to proximity
+
+    Returns grid, node coordinates along x and y
+    """
+    xc = np.linspace(np.min(xx), np.max(xx), gridsize[0])
+    yc = np.linspace(np.min(yy), np.max(yy), gridsize[1])
+    fx = (np.asarray(xx) - xc[0]) / (xc[1] - xc[0])
+    fy = (np.asarray(yy) - yc[0]) / (yc[1] - yc[0])
+    ix = np.minimum(fx.astype(np.intp), gridsize[0] - 2)
+    iy = np.minimum(fy.astype(np.intp), gridsize[1] - 2)
+    fx -= ix
+    fy -= iy
+
+    grid = np.zeros(gridsize)
+    flat = grid.ravel()
+    base = ix*gridsize[1] + iy
+    for shift, w in ((0, (1-fx)*(1-fy)), (1, (1-fx)*fy),
+                     (gridsize[1], fx*(1-fy)), (gridsize[1]+1, fx*fy)):
+        flat += np.bincount(base + shift, weights=w, minlength=flat.size)
+    return grid, xc, yc
+
+
+def _kde_grid(xx, yy, gridsize):
+    """
+    Gaussian KDE (Scott's rule, full covariance) on a regular grid
+    over the data, by FFT convolution of binned points
+
+    Returns density, node coordinates along x and y
+    """
+    n = len(xx)
+    cov = np.atleast_2d(np.cov(np.vstack([xx, yy]))) * n**(-2/6)
+    grid, xc, yc = _linear_binning(xx, yy, gridsize)
+
+    # kernel on grid offsets, cut at 4 sigma or the grid size
+    dx, dy = xc[1] - xc[0], yc[1] - yc[0]
+    hx = min(int(4*np.sqrt(cov[0, 0]) / dx) + 1, gridsize[0] - 1)
+    hy = min(int(4*np.sqrt(cov[1, 1]) / dy) + 1, gridsize[1] - 1)
+    ox, oy = np.meshgrid(np.arange(-hx, hx+1)*dx, np.arange(-hy, hy+1)*dy, indexing='ij')
+    icov = np.linalg.inv(cov)
+    kernel = np.exp(-0.5*(icov[0, 0]*ox**2 + 2*icov[0, 1]*ox*oy + icov[1, 1]*oy**2))
+    kernel /= 2*np.pi*np.sqrt(np.linalg.det(cov)) * n
+
+    density = np.maximum(fftconvolve(grid, kernel, mode='same'), 0)
+    return density, xc, yc
+
+
+def _colorize_z_kdefft(xx, yy, modepars, plotargs):
+    """
+    Gaussian KDE like `_colorize_z_kde` (Scott's rule, full covariance),
+    computed by FFT convolution of binned points, O(N + G log G)
+    """
+    gridsize = modepars.get('gridsize', (512, 512))
+    density, xc, yc = _kde_grid(xx, yy, gridsize)
+    zz = interpn((xc, yc), density, np.column_stack([xx, yy]), method="linear")
+    zlabel = "kde"
+    return zz, zlabel, plotargs
 
-    nb = tree.query_ball_point(gridn.T, searchradius, n_jobs=njobs)
-    zz = np.fromiter(map(len, nb), dtype=int)
 
+def _count_near_tree(points, searchradius, chunksize, njobs):
+    tree = cKDTree(points)
+    zz = np.empty(len(points), dtype=int)
+    # counts only, no lists of neighbours; chunks keep memory flat
+    for start in range(0, len(points), chunksize):
+        chunk = points[start:start+chunksize]
+        zz[start:start+len(chunk)] = tree.query_ball_point(
+            chunk, searchradius, return_length=True, workers=njobs)
+    return zz
+
+
+def _count_near_grid(points, searchradius, pairbudget):
+    """
+    Fixed radius neighbour counts with a cell list,
+    at most pairbudget candidate pairs are checked at once
+
+    Points are sorted by cell and processed in blocks of the sorted
+    order. Only occupied cells are indexed, neighbour cells are found
+    by binary search among them, so besides the result it keeps at most
+    about 56 bytes per point (cell ids, sort order, sorted copy of points,
+    occupied cells and their bounds) whatever the radius, and per block
+    arrays of about pairbudget elements.
+    """
+    ncells = int(np.floor(1 / searchradius)) + 1
+    cell = np.minimum((points[:, 0] / searchradius).astype(np.int64), ncells - 1)
+    cell *= ncells
+    cell += np.minimum((points[:, 1] / searchradius).astype(np.int64), ncells - 1)
+    order = np.argsort(cell, kind='stable')
+    cell = cell[order]
+    sorted_points = points[order]
+    occupied, starts = np.unique(cell, return_index=True)
+    bounds = np.append(starts, len(points))
+    sizes = np.diff(bounds)
+
+    def neighbours(cells, i, j):
+        # first point and number of points of the cell at offset (i, j)
+        cx, cy = np.divmod(cells, ncells)
+        nx, ny = cx + i, cy + j
+        ncell = nx*ncells + ny
+        k = np.minimum(np.searchsorted(occupied, ncell), len(occupied) - 1)
+        found = ((nx >= 0) & (nx < ncells) & (ny >= 0) & (ny < ncells)
+                 & (occupied[k] == ncell))
+        return bounds[k], np.where(found, sizes[k], 0)
+
+    # candidates of every point of a cell are the points of 3x3 cells around it
+    offsets = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+    around = sum(neighbours(occupied, i, j)[1] for i, j in offsets)
+    # block edges in sorted order, a point with more candidates
+    # than the budget still gets a block of its own
+    cumpairs = np.concatenate([[0], np.cumsum(sizes * around)])
+    targets = np.arange(pairbudget, cumpairs[-1], pairbudget)
+    c = np.searchsorted(cumpairs, targets, side='right') - 1
+    edges = bounds[c] + -(-(targets - cumpairs[c]) // np.maximum(around[c], 1))
+    edges = np.unique(np.concatenate([[0], np.minimum(edges, len(points)), [len(points)]]))
+
+    zz = np.zeros(len(points), dtype=int)
+    r2 = searchradius**2
+    for a, b in zip(edges[:-1], edges[1:]):
+        for i, j in offsets:
+            lo, n = neighbours(cell[a:b], i, j)
+            query = np.repeat(np.arange(a, b), n)
+            cand = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())
+            d = sorted_points[cand] - sorted_points[query]
+            close = np.einsum('ij,ij->i', d, d) <= r2
+            zz[a:b] += np.bincount(query[close] - a, minlength=b - a)
+    out = np.empty_like(zz)
+    out[order] = zz
+    return out
+
+
+def _near_plotargs(plotargs, searchradius):
+    """
+    Markers as large as the search circle, stretched with the figure
+    """
     circle = mpath.Path.unit_circle()
     verts = np.copy(circle.vertices)
 
@@ -102,20 +238,125 @@ def _colorize_z_near(xx, yy, modepars, plotargs):
         if plotargs.get('s', None) in ['fair']:
             plotargs['s'] = area_p
         plotargs['marker'] = plotargs.pop('marker', ell_marker)
+    return plotargs
+
+
+def _colorize_z_near(xx, yy, modepars, plotargs):
+    """
+    Number of neighbours within searchradius in coordinates scaled to [0, 1]
+
+    modepars:
+        searchradius -- 0.05 by default
+        backend      -- 'tree' (cKDTree, default) or 'grid' (cell list)
+        chunksize    -- points queried at once by 'tree'
+        njobs        -- threads used by 'tree', -1 for all processors
+        pairbudget   -- candidate pairs checked at once by 'grid'
+    """
+    scalingx = (np.max(xx) - np.min(xx))
+    scalingy = (np.max(yy) - np.min(yy))
+    xxn = (xx - np.min(xx)) / scalingx
+    yyn = (yy - np.min(yy)) / scalingy
 
+    gridn = np.column_stack([xxn, yyn])
+    searchradius = modepars.get('searchradius', 0.05)
+
+    if modepars.get('backend', 'tree') == 'grid':
+        zz = _count_near_grid(gridn, searchradius, modepars.get('pairbudget', 2**20))
+    else:
+        zz = _count_near_tree(gridn, searchradius, modepars.get('chunksize', 2**16),
+                              modepars.get('njobs', -1))
+
+    plotargs = _near_plotargs(plotargs, searchradius)
     zlabel = r"# neighbours"
 
     return zz, zlabel, plotargs
 
 
+def _near_grid(xx, yy, searchradius, gridsize):
+    """
+    Approximate neighbour counts on a grid: histogram in scaled
+    coordinates convolved with a disk of searchradius
+    """
+    h, xe, ye = np.histogram2d(xx, yy, bins=gridsize)
+    rx, ry = searchradius*gridsize[0], searchradius*gridsize[1]
+    ox, oy = np.meshgrid(np.arange(-int(rx), int(rx)+1), np.arange(-int(ry), int(ry)+1),
+                         indexing='ij')
+    disk = ((ox/max(rx, 0.5))**2 + (oy/max(ry, 0.5))**2 <= 1).astype(float)
+    counts = np.maximum(fftconvolve(h, disk, mode='same'), 0)
+    return counts, (xe[1:] + xe[:-1])/2, (ye[1:] + ye[:-1])/2
+
+
+def density_grid(xx, yy, mode, modepars, gridsize=(128, 128)):
+    """
+    Regular grid of the quantity mode colours points with, for contours
+
+    'hist' gives its own histogram, 'near' approximate neighbour counts,
+    other modes the binned KDE. Cost depends on the number of points
+    only through binning.
+
+    Returns node coordinates along x and y and grid of shape (nx, ny),
+    empty nodes (up to FFT round-off) are NaN
+    """
+    if mode == 'hist':
+        z, xc, yc = _hist_grid(xx, yy, modepars.get('bins', (15, 15)))
+    elif mode == 'near':
+        z, xc, yc = _near_grid(xx, yy, modepars.get('searchradius', 0.05), gridsize)
+    else:
+        z, xc, yc = _kde_grid(xx, yy, modepars.get('gridsize', gridsize))
+    z = np.where(z > 1e-9*np.max(z), z, np.nan)
+    return xc, yc, z
+
+
 colorize_z_type = {
     'none': _colorize_z_none,
     'hist': _colorize_z_hist,
     'kde': _colorize_z_kde,
+    'kdefft': _colorize_z_kdefft,
     'near': _colorize_z_near,
 }
 
 
+# plotargs adjustments made by colorize functions, redone on cache hits
+plotargs_adjust = {
+    'near': lambda plotargs, modepars: _near_plotargs(plotargs, modepars.get('searchradius', 0.05)),
+}
+
+
+def fingerprint(a):
+    """
+    Fast content hash of array: crc32 and adler32 of its memory, shape and dtype
+    """
+    a = np.ascontiguousarray(a)
+    buf = memoryview(a).cast('B') if a.size else b""
+    return "{:08x}{:08x}-{}-{}".format(
+        zlib.crc32(buf), zlib.adler32(buf), "x".join(map(str, a.shape)), a.dtype.str)
+
+
+def colorize(xx, yy, mode, modepars, plotargs):
+    """
+    `colorize_z_type`[mode] memoized by contents of xx, yy and mode parameters
+
+    Results are kept in `colorized` (last COLORIZED_MAX) and `colorized_store`.
+    """
+    key = ArrayStore.key(fingerprint(xx), fingerprint(yy), mode, repr(sorted(modepars.items())))
+    entry = colorized.pop(key, None)
+    if entry is None:
+        stored = colorized_store.get(key)
+        if stored is not None:
+            entry = stored[0], stored[1]['zlabel']
+    if entry is None:
+        zz, zlabel, plotargs = colorize_z_type[mode](xx, yy, modepars, plotargs)
+        entry = colorized_store.put(key, np.asarray(zz), {'zlabel': zlabel})[0], zlabel
+    elif mode in plotargs_adjust:
+        plotargs = plotargs_adjust[mode](plotargs, modepars)
+
+    colorized[key] = entry
+    if len(colorized) > COLORIZED_MAX:
+        colorized.popitem(last=False)
+    zz, zlabel = entry
+    return zz, zlabel, plotargs
+
+
 def sort_by_zorder(xx, yy, zz, sortp = True):
     idx = range(len(zz))
     if sortp:
@@ -126,6 +367,58 @@ def sort_by_zorder(xx, yy, zz, sortp = True):
     return idx, xx, yy, zz
 
 
+def aggregate_raster(xx, yy, zz, xrange, yrange, shape, reduce="max"):
+    """
+    Reduce points to a raster of shape (nx, ny) covering xrange, yrange
+
+    reduce -- 'count', 'mean' or 'max' of zz in every pixel
+    Returns raster (NaN in empty pixels), counts and pixel of every point
+    (-1 for points out of range)
+    """
+    nx, ny = shape
+    ix = np.floor((np.asarray(xx) - xrange[0]) / (xrange[1] - xrange[0]) * nx).astype(np.intp)
+    iy = np.floor((np.asarray(yy) - yrange[0]) / (yrange[1] - yrange[0]) * ny).astype(np.intp)
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    pixel = np.where(inside, ix*ny + iy, -1)
+
+    counts = np.bincount(pixel[inside], minlength=nx*ny)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if reduce == "count":
+            raster = counts.astype(float)
+        elif reduce == "mean":
+            raster = np.bincount(pixel[inside], weights=zz[inside], minlength=nx*ny) / counts
+        elif reduce == "max":
+            raster = np.full(nx*ny, -np.inf)
+            np.maximum.at(raster, pixel[inside], zz[inside])
+        else:
+            raise ValueError("reduce must be one of count, mean, max")
+    raster[counts == 0] = np.nan
+    return raster.reshape(shape), counts.reshape(shape), pixel
+
+
+def _scatter_aggregated(ax, xx, yy, zz, xrange, yrange, reduce, sparse,
+                        sort, plotargs, kwargs):
+    """
+    Raster of screen resolution for dense regions,
+    points of pixels with at most sparse points are scattered over it
+    """
+    bbox = ax.get_window_extent()
+    shape = (max(1, int(round(bbox.width))), max(1, int(round(bbox.height))))
+    raster, counts, pixel = aggregate_raster(xx, yy, zz, xrange, yrange, shape, reduce)
+
+    colorargs = {k: kwargs[k] for k in ('cmap', 'norm', 'vmin', 'vmax', 'alpha') if k in kwargs}
+    mapping = ax.imshow(raster.T, origin='lower', aspect='auto', interpolation='nearest',
+                        extent=(*xrange, *yrange), **colorargs)
+
+    lonely = (pixel >= 0) & (counts.ravel()[np.maximum(pixel, 0)] <= sparse)
+    if lonely.any() and reduce != "count":
+        _, lx, ly, lz = sort_by_zorder(np.asarray(xx)[lonely], np.asarray(yy)[lonely],
+                                       zz[lonely], sort)
+        kwargs = {k: v for k, v in kwargs.items() if k not in ('norm', 'vmin', 'vmax')}
+        ax.scatter(lx, ly, c=lz, norm=mapping.norm, **plotargs, **kwargs)
+    return mapping
+
+
 def scatter_density_plot(
     xx,
     yy,
@@ -141,8 +434,19 @@ def scatter_density_plot(
     pointlabellim=np.inf,
     ax=None,
     fig=plt,
+    aggregate=10**6,
+    reduce="max",
+    sparse=1,
     **kwargs
 ):
+    """
+    aggregate -- above this number of points dense regions are drawn as
+                 a raster of the axes resolution (see `aggregate_raster`),
+                 the time to draw stops growing with the number of points
+    reduce    -- what the raster shows: 'count', 'mean' or 'max' of z
+    sparse    -- points of raster pixels with no more points are
+                 scattered as usual
+    """
     ax = plt.gca() if ax is None else ax
 
     plotargs = {}
@@ -150,20 +454,24 @@ def scatter_density_plot(
     plotargs['marker'] = kwargs.pop('marker', 'o')
     plotargs['ax'] = ax
 
-    zz, zlabel, plotargs = colorize_z_type[mode](xx, yy, modepars, plotargs)
-
-    idx, xx, yy, zz = sort_by_zorder(xx, yy, zz, sort)
-
+    zz, zlabel, plotargs = colorize(xx, yy, mode, modepars, plotargs)
+    sample = np.asarray(xx), np.asarray(yy)
     plotargs.pop('ax', None)
-    mapping = ax.scatter(xx, yy, c=zz, **plotargs, **kwargs)
 
-    if contours:
-        grid_x, grid_y = np.mgrid[
-            xrange[0]:xrange[1]:100j,
-            yrange[0]:yrange[1]:100j]
+    if len(zz) > aggregate:
+        mapping = _scatter_aggregated(ax, xx, yy, zz, xrange, yrange, reduce, sparse,
+                                      sort, plotargs, kwargs)
+        idx = np.arange(len(zz))
+        xx, yy = np.asarray(xx), np.asarray(yy)
+        if reduce == "count":
+            zlabel = "# points per pixel"
+    else:
+        idx, xx, yy, zz = sort_by_zorder(xx, yy, zz, sort)
+        mapping = ax.scatter(xx, yy, c=zz, **plotargs, **kwargs)
 
-        grid_z = griddata((xx, yy), zz, (grid_x, grid_y), method="cubic", rescale=True)
-        ax.contour(grid_x, grid_y, grid_z, colors="lightgray", linewidths=1)
+    if contours:
+        grid_x, grid_y, grid_z = density_grid(*sample, mode, modepars)
+        ax.contour(grid_x, grid_y, grid_z.T, colors="lightgray", linewidths=1)
 
     pointradius = np.sqrt(plotargs['s']/np.pi)
 
@@ -207,6 +515,100 @@ def seaborn_to_plotly(scl):
 #   'tempo', 'temps', 'thermal', 'tropic', 'turbid', 'twilight',
 #   'viridis', 'ylgn', 'ylgnbu', 'ylorbr', 'ylorrd']
 
+def lod_subsample(xx, yy, maxpoints, nbins=(200, 200), logx=False, logy=False, seed=0):
+    """
+    Density aware subsample of at most maxpoints points
+
+    All points of sparse bins are kept, denser bins keep the same random
+    number of points each, as many as fits into maxpoints.
+
+    Points that can not be placed on the axes (non-finite, or not
+    positive on a log axis) are left out.
+
+    Returns indices of kept points (in order), counts of points in
+    bins and bin edges along x and y
+    """
+    xx, yy = np.asarray(xx, dtype=float), np.asarray(yy, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bx = np.log10(xx) if logx else xx
+        by = np.log10(yy) if logy else yy
+    valid = np.flatnonzero(np.isfinite(bx) & np.isfinite(by))
+    xx, yy = xx[valid], yy[valid]
+    counts, xe, ye = np.histogram2d(bx[valid], by[valid], bins=nbins)
+    if logx:
+        xe = 10**xe
+    if logy:
+        ye = 10**ye
+    if len(valid) <= maxpoints:
+        return valid, counts, xe, ye
+
+    # largest number of points per bin with at most maxpoints in total
+    lo, hi = 0, int(counts.max())
+    while lo < hi:
+        cap = (lo + hi + 1) // 2
+        if np.minimum(counts, cap).sum() <= maxpoints:
+            lo = cap
+        else:
+            hi = cap - 1
+    cap = lo
+
+    ix = np.clip(np.searchsorted(xe, xx, side='right') - 1, 0, len(xe) - 2)
+    iy = np.clip(np.searchsorted(ye, yy, side='right') - 1, 0, len(ye) - 2)
+    bins = ix*(len(ye) - 1) + iy
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(bins)), bins))
+    sorted_bins = bins[order]
+    rank = np.arange(len(bins)) - np.searchsorted(sorted_bins, sorted_bins)
+    if cap == 0:
+        # more occupied bins than maxpoints, one point of some of them
+        kept = rng.choice(order[rank == 0], maxpoints, replace=False)
+    else:
+        kept = order[rank < cap]
+    return valid[np.sort(kept)], counts, xe, ye
+
+
+def _density_underlay(counts, xe, ye):
+    with np.errstate(divide='ignore'):
+        z = np.where(counts > 0, np.log10(counts), np.nan)
+    return go.Heatmap(
+        x=((xe[1:] + xe[:-1])/2).astype(np.float32),
+        y=((ye[1:] + ye[:-1])/2).astype(np.float32),
+        z=z.T.astype(np.float32),
+        colorscale="greys",
+        showscale=False,
+        opacity=0.5,
+        hoverinfo="skip",
+    )
+
+
+def lod_zoom(figwidget, xx, yy, zz, maxpoints=100000, nbins=(200, 200),
+             logx=False, logy=False, trace=-1):
+    """
+    Resample points of a `go.FigureWidget` made by `scatter_density_plotly`
+    from the full sample whenever the visible window changes
+    """
+    xx, yy, zz = np.asarray(xx), np.asarray(yy), np.asarray(zz)
+
+    def update(layout, xrange, yrange):
+        if xrange is None or yrange is None:
+            return
+        xlo, xhi = 10**np.asarray(xrange, dtype=float) if logx else xrange
+        ylo, yhi = 10**np.asarray(yrange, dtype=float) if logy else yrange
+        visible = np.nonzero((xx >= xlo) & (xx <= xhi) & (yy >= ylo) & (yy <= yhi))[0]
+        if len(visible) == 0:
+            return
+        keep = visible[lod_subsample(xx[visible], yy[visible], maxpoints, nbins, logx, logy)[0]]
+        keep = keep[np.argsort(zz[keep], kind='stable')]
+        points = figwidget.data[trace]
+        with figwidget.batch_update():
+            points.x = xx[keep].astype(np.float32)
+            points.y = yy[keep].astype(np.float32)
+            points.marker.color = zz[keep].astype(np.float32)
+
+    figwidget.layout.on_change(update, 'xaxis.range', 'yaxis.range')
+    return figwidget
+
+
 def scatter_density_plotly(
     xx,
     yy,
@@ -225,20 +627,38 @@ def scatter_density_plotly(
     contours=False,
     pointlabels=None,
     scattertype=go.Scattergl,
+    maxpoints=100000,
+    nbins=(200, 200),
     **kwargs
 ):
+    """
+    maxpoints -- larger samples are thinned with `lod_subsample` and shown
+                 over a heatmap of the full density, so that the figure size
+                 does not grow with the sample; None to show all points
+    nbins     -- bins of the subsampling and the heatmap
+    """
     fig = go.Figure() if fig is None else fig
     plotargs = {}
-    zz, zlabel, plotargs = colorize_z_type[mode](xx, yy, modepars, plotargs)
+    zz, zlabel, plotargs = colorize(xx, yy, mode, modepars, plotargs)
+    sample = np.asarray(xx), np.asarray(yy)
+
+    if maxpoints is not None and len(zz) > maxpoints:
+        keep, counts, xe, ye = lod_subsample(xx, yy, maxpoints, nbins, logx, logy)
+        fig.add_trace(_density_underlay(counts, xe, ye), **subplotpos)
+        xx, yy, zz = np.asarray(xx)[keep], np.asarray(yy)[keep], zz[keep]
+        if pointlabels is not None:
+            pointlabels = np.asarray(pointlabels)[keep]
+
     idx, xx, yy, zz = sort_by_zorder(xx, yy, zz, sort)
 
     alpha = kwargs.get("alpha", 1)
+    # float32 numpy arrays go to the browser as binary typed arrays
     points = scattertype(
-        x=xx,
-        y=yy,
+        x=np.asarray(xx, dtype=np.float32),
+        y=np.asarray(yy, dtype=np.float32),
         mode="markers",
         marker=dict(
-            color=zz,
+            color=np.asarray(zz, dtype=np.float32),
             showscale=True,
             colorscale="matter",
             reversescale=True,
@@ -271,15 +691,11 @@ def scatter_density_plotly(
         points.hovertext = list(np.array(pointlabels)[idx])
 
     if contours:
-        grid_x, grid_y = np.mgrid[
-            np.min(xx) : np.max(xx) : 30j,
-            np.min(yy) : np.max(yy) : 30j
-        ]
-        grid_z = griddata((xx, yy), zz, (grid_x, grid_y), method="cubic", rescale=True)
+        grid_x, grid_y, grid_z = density_grid(*sample, mode, modepars)
         contour = go.Contour(
-            x=grid_x[:, 0],
-            y=grid_y[0, :],
-            z=grid_z.T,
+            x=grid_x.astype(np.float32),
+            y=grid_y.astype(np.float32),
+            z=grid_z.T.astype(np.float32),
             contours_coloring="lines",
             showlegend=False,
             showscale=False,
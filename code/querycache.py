@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    code.querycache
+    ~~~~~~~~~~~~~~~
+
+    Cache of database query results
+
+    Results are keyed by normalized SQL text (comments and extra whitespace
+    stripped) and a schema tag, kept in an in-process LRU and on disk
+    (see `tablestore`). Hits share the cached frame instead of copying it,
+    callers must not modify what they get.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from argparse import Namespace
+from pathlib import Path
+
+from .tablestore import SUFFIX, read_table, write_table
+
+# bump when the server side schema or the result post-processing changes
+SCHEMA = "ps1dr2-2"
+
+_sqltokens = re.compile(r"('(?:[^']|'')*')|--[^\n]*|/\*.*?\*/|\s+", re.S)
+
+
+def normalize_sql(query):
+    """
+    Query text with comments dropped and whitespace collapsed,
+    string literals are kept as they are
+    """
+    return _sqltokens.sub(lambda m: m.group(1) or " ", query).strip()
+
+
+class QueryCache:
+    """
+    Two-tier cache of query results
+
+    path     -- directory of the disk tier
+    schema   -- tag mixed into every key, changing it invalidates everything
+    maxitems -- size of the in-process LRU tier
+    ttl      -- seconds a result stays valid, forever if None
+    """
+    def __init__(self, path, schema=SCHEMA, maxitems=64, ttl=None):
+        self.path = Path(path)
+        self.schema = schema
+        self.maxitems = maxitems
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = Namespace(memory_hits=0, disk_hits=0, misses=0,
+                               lookup_seconds=0., server_seconds=0.)
+
+    def key(self, query):
+        text = self.schema + "\n" + normalize_sql(query)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return self.path / (key + SUFFIX)
+
+    def _fresh(self, stamp):
+        return self.ttl is None or time.time() - stamp < self.ttl
+
+    def get(self, query, copy=False):
+        """
+        Cached result or None
+
+        The result is the cached frame itself, treat it as read-only
+        or pass copy=True for a private copy.
+        """
+        start = time.perf_counter()
+        key = self.key(query)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and self._fresh(entry[0]):
+                self.memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                self.stats.lookup_seconds += time.perf_counter() - start
+                return entry[1].copy() if copy else entry[1]
+
+        f = self._file(key)
+        try:
+            stamp = f.stat().st_mtime
+            df = read_table(f) if self._fresh(stamp) else None
+        except (OSError, ValueError, EOFError):
+            df = None
+
+        with self.lock:
+            if df is None:
+                self.stats.misses += 1
+            else:
+                self.stats.disk_hits += 1
+                self._remember(key, stamp, df)
+            self.stats.lookup_seconds += time.perf_counter() - start
+        return df.copy() if copy and df is not None else df
+
+    def _remember(self, key, stamp, df):
+        self.memory[key] = (stamp, df)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxitems:
+            self.memory.popitem(last=False)
+
+    def put(self, query, df):
+        key = self.key(query)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # every writer gets its own temporary file, the last rename wins
+        tmp = self._file(key).with_suffix(".{}.{}.tmp".format(os.getpid(), threading.get_ident()))
+        write_table(df, tmp)
+        tmp.replace(self._file(key))
+        with self.lock:
+            self._remember(key, time.time(), df)
+
+    def fetch(self, query, run, copy=False):
+        """
+        Cached result of query, run(query) gives it on a miss,
+        read-only unless copy=True as with `get`
+        """
+        df = self.get(query, copy)
+        if df is None:
+            start = time.perf_counter()
+            df = run(query)
+            self.stats.server_seconds += time.perf_counter() - start
+            self.put(query, df)
+            if copy:
+                df = df.copy()
+        return df
+
+    def invalidate(self, query=None):
+        """
+        Forget result of query, or all results if query is None
+        """
+        with self.lock:
+            if query is None:
+                self.memory.clear()
+                files = list(self.path.glob("*" + SUFFIX))
+            else:
+                key = self.key(query)
+                self.memory.pop(key, None)
+                files = [self._file(key)]
+        for f in files:
+            try:
+                f.unlink()
+            except OSError:
+                pass
+
+    def expire(self, ttl=None):
+        """
+        Drop results older than ttl seconds (the cache ttl by default)
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is None:
+            return
+        now = time.time()
+        with self.lock:
+            for key in [k for k, (stamp, _) in self.memory.items() if now - stamp >= ttl]:
+                del self.memory[key]
+        for f in self.path.glob("*" + SUFFIX):
+            try:
+                if now - f.stat().st_mtime >= ttl:
+                    f.unlink()
+            except OSError:
+                pass
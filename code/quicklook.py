@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    code.quicklook
+    ~~~~~~~~~~~~~~
+
+    Matplotlib-free previews of cutouts with profile overlays
+
+    Stamps are rendered straight into uint8 RGB arrays with the same pixel
+    geometry `crosstools.plot_panstarrs` uses, and tiled into contact sheets.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import warnings
+
+import numpy as np
+from astropy.visualization import PercentileInterval, LinearStretch
+from astropy.wcs import WCS
+
+from .crosstools import PANPARS, getfits, profile_ellipses, ref_from_rfgc, _cutout_key
+from .display import display_image
+
+# matplotlib colors used by plot_panstarrs
+COLORS = {
+    'red': (255, 0, 0),
+    'yellow': (255, 255, 0),
+    'orange': (255, 165, 0),
+    'green': (0, 128, 0),
+    'blue': (0, 0, 255),
+    'yellowgreen': (154, 205, 50),
+    'gray': (128, 128, 128),
+}
+
+# the bone colormap is close to this tint of gray
+_BONE = (np.arange(256)[:, None] * np.array([0.85, 0.9, 1.0]) + 0.5).astype(np.uint8)
+
+
+def gray_to_rgb(im):
+    """
+    uint8 image to RGB, bottom row first as in imshow
+    """
+    return _BONE[im[::-1]]
+
+
+def draw_ellipses(rgb, a, b, pos, theta, color, ls='-'):
+    """
+    Rasterize ellipse outlines into rgb in place
+
+    a, b -- semi-axes, pos -- centers (x, y) in pixels with origin
+    at the bottom left, theta -- angles in degrees counterclockwise
+    """
+    a, b, theta = np.asarray(a, float), np.asarray(b, float), np.asarray(theta, float)
+    pos = np.asarray(pos, float).reshape(-1, 2)
+    ok = np.isfinite(a) & np.isfinite(b) & np.isfinite(theta) & np.all(np.isfinite(pos), axis=1)
+    if not ok.any():
+        return rgb
+    a, b, theta, pos = a[ok], b[ok], theta[ok], pos[ok]
+
+    # about a sample per pixel of the longest outline
+    nt = int(np.clip(2*np.pi*np.max(np.maximum(a, b)), 16, 8192))
+    t = np.linspace(0, 2*np.pi, nt, endpoint=False)
+    if ls == '--':
+        # dashes of ~6 pixels along the outline
+        t = t[(np.arange(nt) * 2*np.pi*np.max(np.maximum(a, b)) / nt // 6) % 2 == 0]
+
+    c, s = np.cos(np.radians(theta))[:, None], np.sin(np.radians(theta))[:, None]
+    u, v = a[:, None]*np.cos(t), b[:, None]*np.sin(t)
+    x = np.rint(pos[:, :1] + u*c - v*s).astype(int).ravel()
+    y = np.rint(pos[:, 1:] + u*s + v*c).astype(int).ravel()
+
+    ny, nx = rgb.shape[:2]
+    inside = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+    rgb[ny - 1 - y[inside], x[inside]] = COLORS.get(color, color)
+    return rgb
+
+
+def render_preview(center, size, filt, df, ref=None, image=True,
+                   transform=LinearStretch() + PercentileInterval(99.5),
+                   **profiles):
+    """
+    Cutout at {center} of {size} pixels with profile overlays as uint8 RGB
+
+    Arguments are those of `crosstools.plot_panstarrs`, profile switches
+    (median, kron, ...) go to `crosstools.profile_ellipses`
+    """
+    if image:
+        hdu = getfits(center, size, None, filt)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            wcs = WCS(hdu.header, fix=False)
+        rgb = gray_to_rgb(display_image(hdu.data, transform,
+                                        key=_cutout_key(center, size, filt)))
+    else:
+        wcs = WCS(naxis=2)
+        cdelt = 1/3600/PANPARS.scale
+        wcs.wcs.crpix = [int(size/2), int(size/2)]
+        wcs.wcs.cdelt = np.array([cdelt, cdelt])
+        wcs.wcs.crval = center
+        wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+        wcs.wcs.pc = [[-1, 0], [0, 1]]
+        rgb = np.zeros((size, size, 3), dtype=np.uint8)
+
+    if ref is not None:
+        xy = wcs.all_world2pix([(ref['ra'], ref['dec'])], 0)
+        draw_ellipses(rgb, [ref['a']*PANPARS.scale], [ref['b']*PANPARS.scale], xy,
+                      [ref['PA']], 'gray', ls='--')
+
+    if len(df) > 0:
+        xy = wcs.all_world2pix(df[['raMean', 'decMean']].values, 0)
+        for a, b, theta, color, label, ls in profile_ellipses(df, filt, **profiles):
+            draw_ellipses(rgb, a, b, xy, theta, color, ls=ls)
+    return rgb
+
+
+def preview_rfgc(sample, filt, df, zoom=1, **kwargs):
+    """
+    `render_preview` of an RFGC galaxy, framed like `show_galaxy_rfgc`
+    """
+    ref = ref_from_rfgc(sample)
+    size = 2 * int(ref["a"] * PANPARS.scale)
+    return render_preview((ref["ra"], ref["dec"]), int(size / zoom), filt, df,
+                          ref=ref, **kwargs)
+
+
+def color_preview(cube, filters, transform=LinearStretch() + PercentileInterval(99.5)):
+    """
+    uint8 RGB from a cube of `crosstools.getcube`
+
+    Three bands are picked from red to blue the way `panstarrs.geturl`
+    does for color images, each plane is a slice of the cube.
+    """
+    if len(filters) < 3:
+        raise ValueError("color previews need at least 3 bands")
+    order = sorted(range(len(filters)), key=lambda i: "yzirg".find(filters[i]))
+    order = [order[0], order[len(order)//2], order[-1]]
+    return np.stack([display_image(cube[i], transform) for i in order], axis=-1)[::-1]
+
+
+def contact_sheet(stamps, ncols=10, cell=None, gap=2):
+    """
+    Tile uint8 RGB stamps into one image
+
+    Stamps are centered in cells of `cell` pixels (the largest stamp by
+    default), bigger ones are cropped around the center.
+    """
+    cell = cell or max(max(st.shape[:2]) for st in stamps)
+    nrows = -(-len(stamps) // ncols)
+    sheet = np.zeros((nrows*(cell + gap) + gap, ncols*(cell + gap) + gap, 3), dtype=np.uint8)
+    for k, st in enumerate(stamps):
+        h, w = min(st.shape[0], cell), min(st.shape[1], cell)
+        sy, sx = (st.shape[0] - h)//2, (st.shape[1] - w)//2
+        y0 = gap + (k // ncols)*(cell + gap) + (cell - h)//2
+        x0 = gap + (k % ncols)*(cell + gap) + (cell - w)//2
+        sheet[y0:y0+h, x0:x0+w] = st[sy:sy+h, sx:sx+w]
+    return sheet
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    code.sharding
+    ~~~~~~~~~~~~~
+
+    Split big template queries into shards and run them as CasJobs jobs
+
+    A template declares where the shard condition goes with a placeholder
+    (`{shardwhere}` by default, left empty when the template is expanded
+    as a whole) and writes its result INTO {name}. Every shard gets its
+    own condition and output table {name}_s{i}; shards run concurrently
+    in the long queue and are merged locally as they finish.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from .hmte import expand_templates
+from .crosstools import PANPARS
+from .tablestore import replace_sentinels, compact
+
+# number of galaxies in RFGC
+RFGC_SIZE = 4236
+
+# CasJobs job status codes
+FINISHED = 5
+
+
+def range_shards(column, lo, hi, nshards, integer=False):
+    """
+    WHERE conditions splitting lo <= column <= hi into nshards ranges
+    """
+    edges = np.linspace(lo, hi, nshards + 1)
+    if integer:
+        edges = np.unique(np.rint(edges).astype(int))
+    conds = []
+    for i, (a, b) in enumerate(zip(edges[:-1], edges[1:])):
+        upper = "<=" if i == len(edges) - 2 else "<"
+        conds.append("WHERE {c} >= {a} AND {c} {upper} {b}".format(
+            c=column, a=a, b=b, upper=upper))
+    return conds
+
+
+def rfgc_shards(nshards, column="r.RFGC", size=RFGC_SIZE):
+    """
+    Shards by RFGC number ranges
+    """
+    return range_shards(column, 1, size, nshards, integer=True)
+
+
+def dec_zones(nshards, column="r.DEJ2000"):
+    """
+    Shards by declination zones of equal height
+    """
+    return range_shards(column, -90, 90, nshards)
+
+
+def shard_queries(template, shards, name, placeholder="shardwhere", **kw):
+    """
+    Expanded query for every shard condition
+
+    Returns list of (output table name, query)
+    """
+    if "{" + placeholder + "}" not in template:
+        raise ValueError("template has no {{{}}} to put shard conditions in".format(placeholder))
+    queries = []
+    for i, cond in enumerate(shards):
+        table = "{}_s{}".format(name, i)
+        kw.update({placeholder: cond, 'name': table})
+        queries.append((table, expand_templates(template, **kw)))
+    return queries
+
+
+class JobFailed(RuntimeError):
+    """
+    The server reports a job as failed or cancelled, it has to be resubmitted
+    """
+
+
+def _run_shard(jobs, table, query, context, retries, backoff):
+    jobid = None
+    for attempt in range(retries + 1):
+        try:
+            if jobid is None:
+                # leftovers of a failed attempt would break INTO
+                jobs.drop_table_if_exists(table)
+                jobid = jobs.submit(query, context=context, task_name=table)
+            # errors of monitoring or download leave the job as it is,
+            # the next attempt looks at it again
+            code, status = jobs.monitor(jobid)
+            if code != FINISHED:
+                failed, jobid = jobid, None
+                raise JobFailed("job {} for {} ended as {}".format(failed, table, status))
+            result = jobs.get_table(table)
+            jobs.drop_table(table)
+            df = replace_sentinels(result.to_pandas(), PANPARS.defaultvalue)
+            return compact(df)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def run_sharded(jobs, template, shards, name, context="PanSTARRS_DR2",
+                maxjobs=4, retries=2, backoff=10., progress=None, **kw):
+    """
+    Run template query in shards and merge the results
+
+    Parameters
+    ----------
+    jobs: `mastcasjobs.MastCasJobs`
+        anything with submit, monitor, get_table, drop_table
+        and drop_table_if_exists
+    template: `str`
+        hmte template with a `{shardwhere}` placeholder and INTO {name}
+    shards: list of `str`
+        shard conditions, e.g. from `rfgc_shards` or `dec_zones`
+    name: `str`
+        base name of output tables in MyDB
+    maxjobs: `int`
+        maximal number of jobs in flight
+    retries: `int`
+        how many times to retry a shard, waiting backoff, 2*backoff,
+        4*backoff... seconds in between; it is resubmitted only if the
+        server says its job failed, otherwise the same job is looked at again
+    progress: callable
+        called as progress(ndone, ntotal) after every finished shard
+    kw:
+        other template parameters
+
+    Returns
+    -------
+    df: `DataFrame`
+        merged results of successful shards, in shard order
+    report: `Namespace`
+        `done`, `failed` (table name -> exception) and `elapsed` seconds
+    """
+    queries = shard_queries(template, shards, name, **kw)
+    parts, failed = {}, {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=maxjobs) as pool:
+        futures = {
+            pool.submit(_run_shard, jobs, table, query, context, retries, backoff): i
+            for i, (table, query) in enumerate(queries)
+        }
+        for ndone, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                parts[i] = future.result()
+            except Exception as e:
+                failed[queries[i][0]] = e
+            if progress is not None:
+                progress(ndone, len(queries))
+
+    # in shard order, whichever finished first
+    df = (compact(pd.concat([parts[i] for i in sorted(parts)], ignore_index=True))
+          if parts else pd.DataFrame())
+    report = Namespace(done=len(parts), failed=failed,
+                       elapsed=time.perf_counter() - start)
+    return df, report
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+    code.skycache
+    ~~~~~~~~~~~~~
+
+    Local sky-partitioned store of cone search results
+
+    The sky is cut into declination zones of `cellsize` degrees, every zone
+    into roughly square cells. The store keeps downloaded objects in the
+    cells they lie in and remembers the cells fully inside some already
+    fetched cone, so any cone lying in such cells is answered without the
+    server, looking only at objects of the cells it overlaps.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import pickle
+from argparse import Namespace
+
+import numpy as np
+import pandas as pd
+
+
+def radec2xyz(ra, dec):
+    """
+    Unit vectors for positions in degrees, vectorized
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def angdist(ra1, dec1, ra2, dec2):
+    """
+    Angular distance in degrees, vectorized
+    """
+    chord = np.linalg.norm(radec2xyz(ra1, dec1) - radec2xyz(ra2, dec2), axis=-1)
+    return np.degrees(2*np.arcsin(np.clip(chord/2, 0, 1)))
+
+
+class ConeStore:
+    """
+    Cone search results cached in sky cells
+
+    cellsize -- side of a cell in degrees
+    radec    -- names of object position columns in results
+    idcol    -- column to drop duplicate objects by
+    """
+    def __init__(self, cellsize=1/120, radec=('raMean', 'decMean'), idcol='objID'):
+        self.cellsize = cellsize
+        self.radec = radec
+        self.idcol = idcol
+        self.nzones = int(np.ceil(180 / cellsize))
+        # cells are not wider in ra than their height at the zone edge
+        # closest to the equator
+        zone_lo = -90 + cellsize * np.arange(self.nzones)
+        mindec = np.minimum(np.abs(zone_lo), np.abs(zone_lo + cellsize))
+        mindec[(zone_lo < 0) & (zone_lo + cellsize > 0)] = 0
+        self.ncells = np.maximum(1, (360*np.cos(np.radians(mindec))/cellsize).astype(int))
+        self.skies = {}
+        self.stats = Namespace(local=0, fetched=0)
+
+    def _cell_corners(self, zone, i):
+        h = self.cellsize
+        w = 360 / self.ncells[zone]
+        ra = np.stack([i*w, (i+1)*w, (i+1)*w, i*w], axis=-1)
+        dec = -90 + h*np.stack([zone, zone, zone+1, zone+1], axis=-1)
+        return ra, np.minimum(dec, 90)
+
+    def _cells_of(self, ra, dec):
+        """
+        (zone, index) of cells containing positions, vectorized
+        """
+        zone = np.clip(((np.asarray(dec) + 90) // self.cellsize).astype(int), 0, self.nzones - 1)
+        n = self.ncells[zone]
+        idx = np.minimum((np.asarray(ra) % 360 // (360 / n)).astype(int), n - 1)
+        return zone, idx
+
+    def _cone_box(self, ra, dec, r):
+        """
+        (zone, index) of cells in the bounding box of the cone
+        """
+        h = self.cellsize
+        zlo = max(0, int((dec - r + 90) // h))
+        zhi = min(self.nzones - 1, int((dec + r + 90) // h))
+        # half width of the cone in ra, all around if it covers a pole
+        sinra = np.sin(np.radians(r)) / np.cos(np.radians(dec)) if abs(dec) + r < 90 else 1
+        dra = np.degrees(np.arcsin(sinra)) if sinra < 1 else 180
+        zones, idx = [], []
+        for zone in range(zlo, zhi + 1):
+            n = self.ncells[zone]
+            w = 360 / n
+            if dra >= 180:
+                cells = np.arange(n)
+            else:
+                cells = np.arange(int((ra - dra)//w), int((ra + dra)//w) + 1) % n
+            cells = np.unique(cells)
+            zones.append(np.full(len(cells), zone))
+            idx.append(cells)
+        return np.concatenate(zones), np.concatenate(idx)
+
+    def _cone_cells(self, ra, dec, r):
+        """
+        (zone, index) of cells intersecting the cone, with their corners
+        """
+        zones, idx = self._cone_box(ra, dec, r)
+        cra, cdec = self._cell_corners(zones, idx)
+        # drop cells of the bounding box not touching the cone
+        centre = angdist(ra, dec, cra.mean(axis=-1), cdec.mean(axis=-1))
+        halfdiag = angdist(cra[:, 0], cdec[:, 0], cra[:, 2], cdec[:, 2]) / 2
+        touching = centre <= r + halfdiag
+        return zones[touching], idx[touching], cra[touching], cdec[touching]
+
+    def _sky(self, template, filt):
+        # results of templates not depending on the band are shared
+        key = template.format(ra="{ra}", dec="{dec}", s="{s}", f=filt)
+        if key not in self.skies:
+            # objects are kept in chunks as fetched, cells hold row ranges
+            # of objects lying in them and fetched cones touching them
+            self.skies[key] = Namespace(chunks=[], objects={}, ids=set(), covered=set(),
+                                        cones={}, empty=pd.DataFrame())
+        return self.skies[key]
+
+    def add(self, template, filt, pos, size, df):
+        """
+        Record the result of a cone search at pos (degrees) of size (arcmin)
+        """
+        sky = self._sky(template, filt)
+        ra, dec = pos
+        r = size / 60
+        zones, idx, cra, cdec = self._cone_cells(ra, dec, r)
+        inside = np.all(angdist(ra, dec, cra, cdec) <= r, axis=-1)
+        sky.covered |= set(zip(zones[inside].tolist(), idx[inside].tolist()))
+        for cell in zip(*[a.tolist() for a in self._cone_box(ra, dec, r)]):
+            sky.cones.setdefault(cell, []).append((ra, dec, r))
+
+        sky.empty = df.iloc[:0]
+        ora, odec = [df[c].values for c in self.radec]
+        df = df[np.isfinite(ora) & np.isfinite(odec)]
+        new = np.fromiter((i not in sky.ids for i in df[self.idcol].tolist()), bool, len(df))
+        df = df[new].drop_duplicates(subset=self.idcol)
+        if not len(df):
+            return
+        sky.ids.update(df[self.idcol].tolist())
+
+        # a chunk sorted by cell, cells refer to their row ranges in it
+        zone, i = self._cells_of(df[self.radec[0]].values, df[self.radec[1]].values)
+        order = np.lexsort((i, zone))
+        zone, i = zone[order], i[order]
+        start = np.flatnonzero(np.r_[True, (zone[1:] != zone[:-1]) | (i[1:] != i[:-1])])
+        stop = np.r_[start[1:], len(order)]
+        nchunk = len(sky.chunks)
+        sky.chunks.append(df.iloc[order].reset_index(drop=True))
+        for cell, a, b in zip(zip(zone[start].tolist(), i[start].tolist()),
+                              start.tolist(), stop.tolist()):
+            sky.objects.setdefault(cell, []).append((nchunk, a, b))
+
+    def _fetch_missing(self, fetch, template, filt, ra, dec, r):
+        """
+        Fetch whatever part of the cone is not covered yet,
+        returns whether the server was asked
+        """
+        sky = self._sky(template, filt)
+        # a cone containing this one touches the cell of its centre
+        cell = tuple(c.item() for c in self._cells_of(ra, dec))
+        cones = np.array(sky.cones.get(cell, [])).reshape(-1, 3)
+        if np.any(angdist(ra, dec, cones[:, 0], cones[:, 1]) + r <= cones[:, 2]):
+            return False
+
+        zones, idx, cra, cdec = self._cone_cells(ra, dec, r)
+        missing = np.array([c not in sky.covered for c in zip(zones.tolist(), idx.tolist())],
+                           dtype=bool)
+        if not missing.any():
+            return False
+
+        # smallest handy cone around the uncovered cells,
+        # after fetching it they all become covered
+        c = radec2xyz(cra[missing], cdec[missing]).reshape(-1, 3).mean(axis=0)
+        c /= np.linalg.norm(c)
+        fra = np.degrees(np.arctan2(c[1], c[0])) % 360
+        fdec = np.degrees(np.arcsin(c[2]))
+        fr = angdist(fra, fdec, cra[missing], cdec[missing]).max() * (1 + 1e-9)
+        query = template.format(ra=fra, dec=fdec, s=fr*60, f=filt)
+        self.add(template, filt, (fra, fdec), fr*60, fetch(query))
+        return True
+
+    def search(self, fetch, template, pos, size, filt):
+        """
+        Objects within size (arcmin) of pos (degrees)
+
+        Only the part of the cone not covered yet is requested with
+        fetch(query), the rest comes from local data.
+        """
+        ra, dec = pos
+        r = size / 60
+        if self._fetch_missing(fetch, template, filt, ra, dec, r):
+            self.stats.fetched += 1
+        else:
+            self.stats.local += 1
+
+        sky = self._sky(template, filt)
+        rows = {}
+        for cell in zip(*[a.tolist() for a in self._cone_box(ra, dec, r)]):
+            for nchunk, a, b in sky.objects.get(cell, ()):
+                rows.setdefault(nchunk, []).append(np.arange(a, b))
+        if not rows:
+            return sky.empty
+        objects = pd.concat([sky.chunks[n].iloc[np.concatenate(ranges)]
+                             for n, ranges in rows.items()], ignore_index=True)
+        dist = angdist(ra, dec, *[objects[c].values for c in self.radec])
+        return objects[dist <= r].reset_index(drop=True)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.__dict__, f)
+
+    @classmethod
+    def load(cls, path):
+        store = cls.__new__(cls)
+        with open(path, 'rb') as f:
+            store.__dict__.update(pickle.load(f))
+        return store
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    code.skycells
+    ~~~~~~~~~~~~~
+
+    Local resolution of PS1 stack images (RINGS.V3 tessellation)
+
+    The sky is cut into rings 4 degrees high centered at dec = -90, -86, ..., 90.
+    A ring holds int(360 cos(dec_inner) / 4) projection cells (one at the poles),
+    dec_inner being the ring edge closer to the equator, and the cells are
+    numbered from the south pole eastwards from ra = 0. Every projection cell
+    is a 4x4 degree tangent plane split into 10x10 skycells, numbered
+    10*y + x with x growing westwards.
+
+    This gives the same file names as ps1filenames.py without asking it.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import numpy as np
+from astropy.table import Table
+
+RING_HEIGHT = 4.
+NSUBCELLS = 10
+
+_ring_dec = np.arange(-90, 90 + RING_HEIGHT, RING_HEIGHT)
+_ring_ncells = np.where(
+    np.abs(_ring_dec) == 90, 1,
+    (360*np.cos(np.radians(np.abs(_ring_dec) - RING_HEIGHT/2)) / RING_HEIGHT).astype(int)
+)
+_ring_first = np.concatenate([[0], np.cumsum(_ring_ncells)[:-1]])
+
+_filename = ("/rings.v3.skycell/{p:04d}/{s:03d}/"
+             "rings.v3.skycell.{p:04d}.{s:03d}.stk.{f}.unconv.fits")
+
+
+def findskycell(ra, dec):
+    """
+    Projection cell and skycell numbers of positions in degrees, vectorized
+    """
+    ra, dec = np.asarray(ra, dtype=float) % 360, np.asarray(dec, dtype=float)
+    ring = np.clip(np.floor((dec + 90 + RING_HEIGHT/2) / RING_HEIGHT).astype(int),
+                   0, len(_ring_dec) - 1)
+    n = _ring_ncells[ring]
+    ira = np.rint(ra * n / 360).astype(int) % n
+    projcell = _ring_first[ring] + ira
+
+    # gnomonic projection around the projection cell center
+    ra0, dec0 = np.radians(ira * 360 / n), np.radians(_ring_dec[ring])
+    dra = np.radians(ra) - ra0
+    d = np.radians(dec)
+    cosc = np.sin(dec0)*np.sin(d) + np.cos(dec0)*np.cos(d)*np.cos(dra)
+    xi = np.degrees(np.cos(d)*np.sin(dra) / cosc)
+    eta = np.degrees((np.cos(dec0)*np.sin(d) - np.sin(dec0)*np.cos(d)*np.cos(dra)) / cosc)
+
+    step = RING_HEIGHT / NSUBCELLS
+    # points at the very edges of the cell go to the outermost skycells
+    x = np.clip(np.floor((RING_HEIGHT/2 - xi) / step).astype(int), 0, NSUBCELLS - 1)
+    y = np.clip(np.floor((eta + RING_HEIGHT/2) / step).astype(int), 0, NSUBCELLS - 1)
+    return projcell, NSUBCELLS*y + x
+
+
+def skycell_filenames(ra, dec, filters="grizy"):
+    """
+    Stack file names covering positions, vectorized
+
+    Returns array of shape (npositions, nfilters)
+    """
+    projcell, skycell = findskycell(np.atleast_1d(ra), np.atleast_1d(dec))
+    return np.array([
+        [_filename.format(p=p, s=s, f=f) for f in filters]
+        for p, s in zip(projcell.tolist(), skycell.tolist())
+    ])
+
+
+def getimages_local(ra, dec, size=240, filters="grizy"):
+    """
+    Table of images like `panstarrs.getimages` gives, without the service
+    """
+    projcell, skycell = findskycell(ra, dec)
+    names = skycell_filenames(ra, dec, filters)[0]
+    return Table({
+        'projcell': [int(projcell)] * len(filters),
+        'subcell': [int(skycell)] * len(filters),
+        'ra': [float(ra)] * len(filters),
+        'dec': [float(dec)] * len(filters),
+        'filter': list(filters),
+        'mjd': [0.] * len(filters),
+        'type': ['stack'] * len(filters),
+        'filename': list(names),
+        'shortname': [name.rsplit('/', 1)[1] for name in names],
+        'badflag': [0] * len(filters),
+    })
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    code.stamps
+    ~~~~~~~~~~~
+
+    Batch rendering of galaxy stamps
+
+    Every stamp is drawn on its own Agg figure in a pool of processes,
+    the global pyplot state is never touched.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import time
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from .crosstools import show_galaxy_rfgc
+
+
+def _render_stamp(sample, filt, df, path, figsize, kwargs):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    show_galaxy_rfgc(sample, filt, df=df, fig=fig, **kwargs)
+    fig.savefig(path)
+    return path
+
+
+def render_stamps(rfgc, ids, filt, df, outdir, fmt="png", nprocs=None,
+                  figsize=(7, 7), progress=None, **kwargs):
+    """
+    Render stamps of many RFGC galaxies in parallel
+
+    Parameters
+    ----------
+    rfgc: `pandas.DataFrame`
+        RFGC catalog (`RFGC`, `RAJ2000`, `DEJ2000`, `aO`, `bO`, `PA`)
+    ids: iterable of `int`
+        RFGC numbers to render
+    filt: `str`
+        band
+    df: `pandas.DataFrame`
+        PanSTARRS detections with the `RFGC` column they are matched to
+    outdir: `str`
+        where to put stamps, named RFGC{id}_{filt}.{fmt}
+    fmt: `str`
+        png or pdf
+    nprocs: `int`
+        number of processes, all cores by default
+    progress: callable
+        called as progress(ndone, ntotal) after every stamp
+
+    other keywords go to `show_galaxy_rfgc`
+
+    Returns
+    -------
+    report: `Namespace`
+        `done`, `failed` (id -> exception), `elapsed` seconds and `rate`
+        in stamps per second
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    rfgc = rfgc.set_index('RFGC', drop=False)
+    groups = dict(iter(df.groupby('RFGC')))
+    empty = df.iloc[:0]
+    ids = list(ids)
+
+    done, failed = 0, {}
+    for i in ids:
+        if i not in rfgc.index:
+            failed[i] = KeyError("RFGC {} is not in the catalog".format(i))
+    ndone = len(failed)
+    if progress is not None and ndone:
+        progress(ndone, len(ids))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=nprocs or os.cpu_count()) as pool:
+        futures = {
+            pool.submit(_render_stamp, rfgc.loc[i], filt, groups.get(i, empty),
+                        outdir / "RFGC{}_{}.{}".format(i, filt, fmt), figsize, kwargs): i
+            for i in ids if i not in failed
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                done += 1
+            except Exception as e:
+                failed[futures[future]] = e
+            ndone += 1
+            if progress is not None:
+                progress(ndone, len(ids))
+
+    elapsed = time.perf_counter() - start
+    return Namespace(done=done, failed=failed, elapsed=elapsed,
+                     rate=done / elapsed if elapsed > 0 else float('nan'))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    code.tablestore
+    ~~~~~~~~~~~~~~~
+
+    Compact storage of catalog tables
+
+    Photometric and shape columns are kept in float32, positions stay in
+    float64, objID is int64 and objName is categorical. Tables are written
+    as Parquet when pyarrow is installed and pickled otherwise.
+
+    Column sets are the same as for `hmte.expand_templates`, names with
+    band patterns like {f}SerRadius.
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from .hmte import expand_columns
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+SUFFIX = ".parquet" if pq is not None else ".pkl"
+
+# float32 is ~0.1 arcsec at ra ~ 300, not enough for positions
+_positions = re.compile(r"(ra|dec)(mean)?$|^(ra|de)j2000$", re.I)
+
+
+def replace_sentinels(df, value):
+    """
+    Replace value (like -999) with NaN column by column, in place
+    """
+    for c in df.columns:
+        col = df[c].to_numpy()
+        if col.dtype.kind in 'fiu':
+            bad = col == value
+            if bad.any():
+                df[c] = df[c].mask(bad)
+    return df
+
+
+def compact(df):
+    """
+    Downcast columns to storage types, in place
+    """
+    for c in df.columns:
+        col = df[c]
+        if c == 'objID' and col.notna().all():
+            df[c] = col.astype(np.int64)
+        elif c == 'objName':
+            df[c] = col.astype('category')
+        elif col.dtype.kind == 'f' and not _positions.search(c):
+            df[c] = col.astype(np.float32)
+    return df
+
+
+def _wanted(names, columns):
+    columns = expand_columns(columns)
+    return [c for c in names if c in columns]
+
+
+def write_table(df, path, columns=None):
+    """
+    Write table, optionally only columns from a column set
+    """
+    if columns is not None:
+        df = df[_wanted(df.columns, columns)]
+    if pq is not None:
+        df.to_parquet(path, index=False)
+    else:
+        df.to_pickle(path)
+
+
+def read_table(path, columns=None):
+    """
+    Read table written by `write_table`, optionally only columns
+    from a column set (those missing in the file are skipped)
+
+    Parquet files are memory-mapped and converted to pandas
+    without keeping a second copy of the data.
+    """
+    if pq is not None:
+        if columns is not None:
+            columns = _wanted(pq.read_schema(path).names, columns)
+        table = pq.read_table(path, columns=columns, memory_map=True)
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    df = pd.read_pickle(path)
+    return df if columns is None else df[_wanted(df.columns, columns)]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_crosstools
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Batched cone search against the fake CasJobs client
+
+    run from the repository root:
+        python -m pytest tests
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from code import crosstools
+from code.querycache import QueryCache
+from benchmarks.fakecasjobs import FakeJobs
+
+TEMPLATE = (Path(__file__).parent.parent / "queries" / "batch_cone.tsql").read_text()
+
+
+class RecordingJobs(FakeJobs):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.queries = []
+
+    def quick(self, query, task_name=None, **kwargs):
+        self.queries.append(query)
+        return super().quick(query, task_name, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def local_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(crosstools, "queries", QueryCache(tmp_path / "queries"))
+
+
+def positions(n):
+    return pd.DataFrame({'id': range(1, n + 1), 'ra': [10. + i/100 for i in range(n)],
+                         'dec': 20., 'size': 0.5})
+
+
+def test_batch_cone_rowset_rendered_once():
+    jobs = RecordingJobs(nobjects=3)
+    crosstools.cone_batch_search(jobs, TEMPLATE, positions(5), "g")
+    query, = jobs.queries
+    assert query.count("VALUES") == 1
+    code = "\n".join(line for line in query.splitlines() if not line.lstrip().startswith("--"))
+    assert code.count("(1, ") == 1 and code.count("(5, ") == 1
+    assert all("(" not in line for line in query.splitlines() if line.lstrip().startswith("--"))
+
+
+def test_batch_cone_results_by_id():
+    found = crosstools.cone_batch_search(FakeJobs(nobjects=3), TEMPLATE, positions(7), "g", chunksize=3)
+    assert sorted(found) == list(range(1, 8))
+    assert all(len(df) == 3 and 'id' not in df for df in found.values())
+
+
+def test_batch_cone_empty():
+    assert crosstools.cone_batch_search(FakeJobs(), TEMPLATE, positions(0), "g") == {}
+
+
+def test_fake_rejects_rowset_in_comment():
+    rowset = crosstools._positions_rowset(positions(3))
+    broken = "-- {positions}\n" + TEMPLATE.split("\n", 2)[2]
+    with pytest.raises(Exception, match="VALUES"):
+        FakeJobs().quick(broken.format(positions=rowset, f="g"))
+
+
+def test_batch_cone_permanent_error_not_split():
+    class Broken(RecordingJobs):
+        def quick(self, query, task_name=None, **kwargs):
+            self.queries.append(query)
+            raise Exception("Login failed")
+
+    jobs = Broken()
+    with pytest.raises(Exception, match="Login failed"):
+        crosstools.cone_batch_search(jobs, TEMPLATE, positions(8), "g")
+    assert len(jobs.queries) == 1
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_plotutils
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Level of detail subsampling of plotly scatter-density plots
+
+    run from the repository root:
+        python -m pytest tests
+
+    :copyright: (c) 2019 by taxus-d.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from argparse import Namespace
+from contextlib import contextmanager
+
+import numpy as np
+
+from code.plotutils import lod_subsample, lod_zoom
+
+
+class FakeFigureWidget:
+    """
+    What `lod_zoom` uses of `go.FigureWidget`
+    """
+    def __init__(self):
+        self.callbacks = []
+        self.layout = Namespace(on_change=lambda cb, *names: self.callbacks.append(cb))
+        self.data = [Namespace(x=None, y=None, marker=Namespace(color=None))]
+
+    @contextmanager
+    def batch_update(self):
+        yield
+
+    def zoom(self, xrange, yrange):
+        for cb in self.callbacks:
+            cb(self.layout, xrange, yrange)
+
+
+def sample(n, seed=0):
+    rng = np.random.default_rng(seed)
+    xx = 10**rng.normal(0, 1, n)
+    yy = 10**rng.normal(0, 1, n)
+    return xx, yy
+
+
+def test_lod_subsample_bounded():
+    xx, yy = sample(50000)
+    keep, counts, xe, ye = lod_subsample(xx, yy, 5000, (50, 50))
+    assert len(keep) <= 5000
+    assert np.all(np.diff(keep) > 0)
+    assert counts.sum() == len(xx)
+    # points of the sparsest bins are all kept
+    ix = np.searchsorted(xe, xx, side='right') - 1
+    lonely = np.flatnonzero(np.bincount(ix, minlength=len(xe))[ix] == 1)
+    assert np.isin(lonely, keep).all()
+
+
+def test_lod_subsample_small_sample_kept():
+    xx, yy = sample(100)
+    keep, counts, _, _ = lod_subsample(xx, yy, 1000)
+    assert np.array_equal(keep, np.arange(100))
+
+
+def test_lod_subsample_log_nonpositive():
+    xx, yy = sample(20000)
+    xx[:100] = 0
+    xx[100:200] = -1
+    yy[200:300] = np.nan
+    keep, counts, xe, ye = lod_subsample(xx, yy, 5000, logx=True, logy=True)
+    assert 0 < len(keep) <= 5000
+    assert np.all(xx[keep] > 0) and np.all(np.isfinite(yy[keep]))
+    assert counts.sum() == len(xx) - 300
+    assert np.all(np.isfinite(xe)) and np.all(np.isfinite(ye))
+
+
+def test_lod_zoom_resamples_visible():
+    xx, yy = sample(20000)
+    zz = np.arange(len(xx))[::-1].astype(float)
+    fig = FakeFigureWidget()
+    assert lod_zoom(fig, xx, yy, zz, maxpoints=1000, nbins=(20, 20)) is fig
+
+    fig.zoom((0.5, 2.), (0.5, 2.))
+    points = fig.data[-1]
+    assert 0 < len(points.x) <= 1000
+    assert np.all((points.x >= 0.5) & (points.x <= 2.) & (points.y >= 0.5) & (points.y <= 2.))
+    # drawn in the order of colour, as `sort_by_zorder` does
+    assert np.all(np.diff(points.marker.color) >= 0)
+
+
+def test_lod_zoom_log_axes():
+    xx, yy = sample(20000)
+    xx[:500] = -1
+    fig = FakeFigureWidget()
+    lod_zoom(fig, xx, yy, np.ones_like(xx), maxpoints=1000, logx=True, logy=True)
+
+    fig.zoom((-1, 1), (-1, 1))
+    points = fig.data[-1]
+    assert 0 < len(points.x) <= 1000
+    assert np.all((points.x >= 0.1 * (1 - 1e-6)) & (points.x <= 10 * (1 + 1e-6)))
+
+
+def test_lod_zoom_ignores_empty_window():
+    xx, yy = sample(1000)
+    fig = FakeFigureWidget()
+    lod_zoom(fig, xx, yy, np.ones_like(xx))
+    fig.zoom((1e6, 1e7), (1e6, 1e7))
+    fig.zoom(None, None)
+    assert fig.data[-1].x is None